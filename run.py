@@ -1,5 +1,7 @@
-
+import multiprocessing
 import storyTime
 
 if __name__ == '__main__':
-    storyTime.main()
\ No newline at end of file
+    # lets image decoding worker processes start in frozen builds
+    multiprocessing.freeze_support()
+    storyTime.main()
@@ -108,6 +108,19 @@ class AudioRecording(object):
             os.close(fd)
         return self._tempFile
     
+    def moveTempFile(self, dir_=None):
+        """
+        Move the file the audio is recorded to into the given
+        directory, or the system temp directory by default
+        """
+        if dir_ is not None and not os.path.isdir(dir_):
+            os.makedirs(dir_)
+        fd, tempFile = tempfile.mkstemp('_audioRecording.wav', dir=dir_)
+        os.close(fd)
+        if self._tempFile is not None:
+            shutil.move(self._tempFile, tempFile)
+        self._tempFile = tempFile
+    
     @property
     def hasRecording(self):
         """ Whether the AudioRecording has an actual recording yet or not"""
@@ -233,7 +246,6 @@ class AudioRecorder(AudioHandler):
         super(AudioRecorder, self).__init__(filename)
         self._isRecording = False
         self.duration = 0
-        self.allSound = []
     
     @property
     def isRecording(self):
@@ -261,29 +273,29 @@ class AudioRecorder(AudioHandler):
     def run(self):
         self._isRecording = True
         opts = self.getStreamOpts()
-        data = self.recordData(opts)
-        self.writeData(data, opts)
+        self.recordData(opts)
         LOG.debug('recorded audio: {0}'.format(self.filename))
     
     def recordData(self, opts):
-        # create stream and start recording
+        # create stream and start recording. each chunk is written
+        # to the wave file as it arrives, so that the audio is already
+        # on disk if the recording is interrupted
+        wf = self.openWave(opts)
         stream = self.pyaudio.open(**opts)
-        self.allSound = []
-        while self._isRecording or len(self.allSound) == 0:
+        chunks = 0
+        while self._isRecording or chunks == 0:
             data = stream.read(1024)
-            self.allSound.append(data)
-        
+            wf.writeframes(data)
+            chunks += 1
         stream.close()
-        return ''.join(self.allSound)
+        wf.close()
     
-    def writeData(self, data, opts):
-        # write out the wave file
+    def openWave(self, opts):
         wf = wave.open(self.filename, 'wb')
         wf.setnchannels(opts['channels'])
         wf.setsampwidth(self.pyaudio.get_sample_size(opts['format']))
         wf.setframerate(opts['rate'])
-        wf.writeframes(data)
-        wf.close()
+        return wf
     
     def stop(self):
         """Stop the recording and rejoin the main thread"""
@@ -5,6 +5,7 @@ Created by Bohdon Sayre on 2012-03-26.
 Copyright (c) 2012 Moonbot Studios. All rights reserved.
 """
 
+from data import FPS_OPTIONS
 from models import Mappings, StoryTimeModel
 from PySide.QtCore import *
 from PySide.QtGui import *
@@ -134,7 +135,8 @@ class StoryTimeWindow(object):
         
         # build some dynamic menus
         self.buildAudioInputsMenu()
-        self.ui.menuFPS.setEnabled(False)
+        self.buildEditMenu()
+        self.buildFpsMenu()
         # hookup menu actions
         self.ui.menuFile.aboutToShow.connect(self.fileMenuAboutToShow)
         self.ui.actionNewRecording.triggered.connect(self.newRecording)
@@ -145,6 +147,18 @@ class StoryTimeWindow(object):
         self.ui.actionOpenStoryTimeDir.triggered.connect(self.openStoryTimePath)
         self.ui.actionImportImages.triggered.connect(self.importImages)
         self.ui.actionClearImages.triggered.connect(self._model.clearImages)
+        self.ui.actionWatchImageDirs = QAction('Watch Image Folders', self.ui)
+        self.ui.actionWatchImageDirs.setCheckable(True)
+        self.ui.actionWatchImageDirs.setChecked(self._model.watchImageDirs)
+        self.ui.actionWatchImageDirs.toggled.connect(self._model.setWatchImageDirs)
+        self.ui.menuFile.addAction(self.ui.actionWatchImageDirs)
+        self.ui.actionShowCacheStats = QAction('Show Cache Stats', self.ui)
+        self.ui.actionShowCacheStats.setCheckable(True)
+        self.ui.actionShowCacheStats.toggled.connect(self.curImageView.setStatsVisible)
+        self.ui.menuFile.addAction(self.ui.actionShowCacheStats)
+        self.ui.actionSaveCacheStats = QAction('Save Cache Stats', self.ui)
+        self.ui.actionSaveCacheStats.triggered.connect(self.saveCacheStats)
+        self.ui.menuFile.addAction(self.ui.actionSaveCacheStats)
         self.ui.actionNewRecording.setShortcut(QKeySequence(Qt.CTRL + Qt.Key_N))
         self.ui.actionOpenRecording.setShortcut(QKeySequence(Qt.CTRL + Qt.Key_O))
         self.ui.actionSaveRecordingAs.setShortcut(QKeySequence(Qt.CTRL + Qt.Key_S))
@@ -155,6 +169,82 @@ class StoryTimeWindow(object):
         # Active and reveal the window
         self.ui.activateWindow()
         self.ui.raise_()
+        
+        self.recoverRecordings()
+    
+    def buildEditMenu(self):
+        self.ui.actionUndo = QAction('Undo', self.ui)
+        self.ui.actionUndo.setShortcut(QKeySequence(Qt.CTRL + Qt.Key_Z))
+        self.ui.actionUndo.triggered.connect(self._model.undo)
+        self.ui.actionRedo = QAction('Redo', self.ui)
+        self.ui.actionRedo.setShortcut(QKeySequence(Qt.CTRL + Qt.SHIFT + Qt.Key_Z))
+        self.ui.actionRedo.triggered.connect(self._model.redo)
+        firstAction = self.ui.menuEdit.actions()[0] if len(self.ui.menuEdit.actions()) else None
+        self.ui.actionConsolidate = QAction('Merge Repeated Images', self.ui)
+        self.ui.actionConsolidate.triggered.connect(self.consolidateRecording)
+        self.ui.actionConsolidateOnStop = QAction('Merge Repeated Images After Recording', self.ui)
+        self.ui.actionConsolidateOnStop.setCheckable(True)
+        self.ui.actionConsolidateOnStop.setChecked(self._model.consolidateOnStop)
+        self.ui.actionConsolidateOnStop.toggled.connect(self.setConsolidateOnStop)
+        self.ui.menuEdit.insertAction(firstAction, self.ui.actionUndo)
+        self.ui.menuEdit.insertAction(firstAction, self.ui.actionRedo)
+        self.ui.menuEdit.insertSeparator(firstAction)
+        self.ui.menuEdit.insertAction(firstAction, self.ui.actionConsolidate)
+        self.ui.menuEdit.insertAction(firstAction, self.ui.actionConsolidateOnStop)
+        self.ui.menuEdit.insertSeparator(firstAction)
+        self.ui.menuEdit.aboutToShow.connect(self.editMenuAboutToShow)
+        self.ui.menuEdit.aboutToHide.connect(self.editMenuAboutToHide)
+    
+    def buildFpsMenu(self):
+        self.ui.fpsGroup = QActionGroup(self.ui)
+        self.ui.fpsGroup.triggered.connect(self.fpsGroupTriggered)
+        for fps in sorted(FPS_OPTIONS.keys()):
+            action = getattr(self.ui, 'action{0}'.format(fps))
+            action.setData(fps)
+            self.ui.fpsGroup.addAction(action)
+        self.ui.actionCustom_2.setCheckable(True)
+        self.ui.actionCustom_2.setData(0)
+        self.ui.fpsGroup.addAction(self.ui.actionCustom_2)
+        self.ui.menuFPS.aboutToShow.connect(self.updateFpsMenu)
+        self.updateFpsMenu()
+    
+    def updateFpsMenu(self):
+        fps = self._model.recordingFps
+        for action in self.ui.fpsGroup.actions():
+            isCustom = action.data() == 0 and fps not in FPS_OPTIONS
+            action.setChecked(action.data() == fps or isCustom)
+            action.setEnabled(not self._model.isRecording)
+        if fps in FPS_OPTIONS:
+            self.ui.actionCustom_2.setText('Custom...')
+        else:
+            self.ui.actionCustom_2.setText('Custom ({0} fps)...'.format(fps))
+    
+    def fpsGroupTriggered(self, action):
+        fps = action.data()
+        if fps == 0:
+            fps, ok = QInputDialog.getInt(self.ui, 'Custom Framerate', 'Frames per second:', self._model.recordingFps, 1, 240)
+            if not ok:
+                self.updateFpsMenu()
+                return
+        self._model.setRecordingFps(fps)
+        self.updateFpsMenu()
+    
+    def editMenuAboutToShow(self):
+        self.ui.actionUndo.setEnabled(self._model.canUndo)
+        self.ui.actionRedo.setEnabled(self._model.canRedo)
+        self.ui.actionConsolidate.setEnabled(not self._model.isRecording and len(self._model.curRecording) > 0)
+    
+    def consolidateRecording(self):
+        if not self._model.isRecording:
+            self._model.consolidateRecording()
+    
+    def setConsolidateOnStop(self, value):
+        self._model.consolidateOnStop = value
+    
+    def editMenuAboutToHide(self):
+        # keep the shortcuts available, the model ignores them when there is nothing to do
+        self.ui.actionUndo.setEnabled(True)
+        self.ui.actionRedo.setEnabled(True)
     
     def setPrevImageViewVisible(self, visible):
         self.setImageViewVisible('prev', visible)
@@ -243,9 +333,24 @@ class StoryTimeWindow(object):
         if event.key() == Qt.Key_BracketLeft:
             self.imageSlider.ui.PrevImageCheck.toggle()
             return True
+        if event.key() == Qt.Key_Escape and self._model.isLoadingImages:
+            self._model.cancelImageLoad()
+            return True
+        if event.key() == Qt.Key_Escape and self._model.isCachingImages:
+            self._model.cancelImageCache()
+            return True
         
         return False
     
+    def recoverRecordings(self):
+        count = self._model.recoverRecordings()
+        if count > 0:
+            msgBox = QMessageBox(self.ui)
+            msgBox.setText('Recovered {0} unsaved recording(s).'.format(count))
+            msgBox.setInformativeText('They have been saved to {0}'.format(self._model.getStoryTimePath()))
+            msgBox.setDefaultButton(QMessageBox.Ok)
+            msgBox.exec_()
+    
     def fileMenuAboutToShow(self):
         hasRecording = len(self._model.curRecording) > 0
         self.ui.actionSaveRecordingAs.setEnabled(hasRecording)
@@ -257,6 +362,9 @@ class StoryTimeWindow(object):
         if os.path.isdir(dir_):
             utils.openDir(dir_)
     
+    def saveCacheStats(self):
+        utils.openDir(self._model.dumpCacheStats())
+    
     def loadPaths(self, paths):
         self._model.loadPaths(paths)
     
@@ -355,11 +463,19 @@ class ImageView(QWidget):
         # for use when adjusting layout stretch
         self.index = index
         self.ui.GraphicsView.setStyleSheet( 'QGraphicsView { border-style: none; }' )
+        # debug overlay of cache stats, created when first shown
+        self.statsLabel = None
+        self.statsTimer = None
     
     def getPixmap(self):
         return self.ui.GraphicsPixmapItem.pixmap()
     def setPixmap(self, data):
+        if data.isNull() and self._model.isImagePending(self.pixmapMapping):
+            # keep showing the last frame until the new image is decoded
+            return
         self.ui.GraphicsPixmapItem.setPixmap(data)
+        # the scene would otherwise keep the bounds of the largest pixmap shown
+        self.ui.GraphicsView.scene().setSceneRect(self.ui.GraphicsPixmapItem.boundingRect())
         self.resizeEvent()
     pixmap = Property("QPixmap", getPixmap, setPixmap)
     
@@ -378,7 +494,35 @@ class ImageView(QWidget):
         self._dataMapper.toFirst()
     
     def resizeEvent(self, event=None):
+        if event is not None:
+            # decode images at the resolution they are displayed at
+            size = self.ui.GraphicsView.viewport().size()
+            self._model.setImageViewSize(self.pixmapMapping, max(size.width(), size.height()))
         self.ui.GraphicsView.fitInView(self.ui.GraphicsView.scene().itemsBoundingRect(), Qt.KeepAspectRatio)
+    
+    def setStatsVisible(self, visible):
+        """ Show or hide an overlay of the model's cache stats """
+        if self.statsLabel is None:
+            if not visible:
+                return
+            self.statsLabel = QLabel(self)
+            self.statsLabel.setStyleSheet('QLabel { color: white; background-color: rgba(0, 0, 0, 160); padding: 4px; font-family: monospace; }')
+            self.statsLabel.setAttribute(Qt.WA_TransparentForMouseEvents)
+            self.statsLabel.move(8, 8)
+            self.statsTimer = QTimer(self)
+            self.statsTimer.setInterval(500)
+            self.statsTimer.timeout.connect(self.updateStats)
+        self.statsLabel.setVisible(visible)
+        if visible:
+            self.updateStats()
+            self.statsLabel.raise_()
+            self.statsTimer.start()
+        else:
+            self.statsTimer.stop()
+    
+    def updateStats(self):
+        self.statsLabel.setText(formatCacheStats(self._model.getCacheStats()))
+        self.statsLabel.adjustSize()
 
 
 
@@ -397,6 +541,8 @@ class ImageSlider(QWidget):
         self._dataMapper = QDataWidgetMapper()
         
         self.ui.ImageSlider.valueChanged.connect(self._dataMapper.submit)
+        # ImageSliderProgress mirrors the slider, so loading and caching show their own progress
+        self.ui.LoadProgress.hide()
         self.ui.PrevImageCheck.toggled.connect(StoryTimeWindow.instance().setPrevImageViewVisible)
         self.ui.NextImageCheck.toggled.connect(StoryTimeWindow.instance().setNextImageViewVisible)
     
@@ -411,6 +557,10 @@ class ImageSlider(QWidget):
         self._model = model
         self.ui.CacheImagesBtn.clicked.connect(self._model.cacheAllImages)
         self.ui.ClearCacheBtn.clicked.connect(self._model.clearCache)
+        self._model.imageLoadProgress.connect(self.imageLoadProgress)
+        self._model.imageLoadFinished.connect(self.imageLoadFinished)
+        self._model.imageCacheProgress.connect(self.imageCacheProgress)
+        self._model.imageCacheFinished.connect(self.imageCacheFinished)
         self._dataMapper.setModel(model)
         self._dataMapper.addMapping(self.ui.ImagePath, Mappings.curImagePath, 'text')
         self._dataMapper.addMapping(self.ui.ImageSlider, Mappings.curImageIndex, 'sliderPosition')
@@ -419,6 +569,32 @@ class ImageSlider(QWidget):
         self._dataMapper.toFirst()
         
     
+    def imageLoadProgress(self, count):
+        # the total is unknown while scanning, so show a busy indicator
+        self.ui.LoadProgress.setRange(0, 0)
+        self.ui.LoadProgress.setToolTip('Loading images... {0} found (Esc to cancel)'.format(count))
+        self.ui.LoadProgress.show()
+    
+    def imageLoadFinished(self):
+        self.ui.LoadProgress.hide()
+        self.ui.LoadProgress.setToolTip('')
+    
+    def imageCacheProgress(self, processed, total):
+        self.ui.CacheImagesBtn.setText('Cancel')
+        self.ui.LoadProgress.setRange(0, max(total, 1))
+        self.ui.LoadProgress.setValue(processed)
+        self.ui.LoadProgress.setToolTip('Caching images... {0} of {1} (Esc to cancel)'.format(processed, total))
+        self.ui.LoadProgress.show()
+    
+    def imageCacheFinished(self, cached, total):
+        self.ui.CacheImagesBtn.setText('Cache All')
+        self.imageLoadFinished()
+        if cached < total:
+            # let the user know when the cache could not hold every image
+            self.ui.CacheImagesBtn.setToolTip('Cached {0} of {1} images'.format(cached, total))
+        else:
+            self.ui.CacheImagesBtn.setToolTip('')
+    
     def installEventFilter(self, filter):
         # install the event filter on all appropriate objects
         self.ui.ImageSlider.installEventFilter(filter)
@@ -613,6 +789,28 @@ class TimeSlider(QWidget):
 
 
 
+def formatCacheStats(stats):
+    """ Return a readable summary of the cache stats from StoryTimeModel.getCacheStats """
+    mb = 1024.0 ** 2
+    counters = stats['counters']
+    resident = stats['resident']
+    hitRate = stats['hitRate']
+    lines = [
+        'Cache: {0:.0f} / {1:.0f} MB, peak {2:.0f} MB, {3} pixmaps'.format(
+            resident['bytes'] / mb, resident['maxBytes'] / mb, stats['peakBytes'] / mb, resident['count']),
+        'Hits: {0}  Lower tier: {1}  Misses: {2}  Hit rate: {3}'.format(
+            counters.get('hits', 0), counters.get('lowerTierHits', 0), counters.get('misses', 0),
+            '-' if hitRate is None else '{0:.0%}'.format(hitRate)),
+        'Prefetch hits: {0}  misses: {1}  Pending decodes: {2}'.format(
+            counters.get('prefetchHits', 0), counters.get('prefetchMisses', 0), stats['pendingDecodes']),
+        'Evictions: {0} ({1:.0f} MB)'.format(counters.get('evictions', 0), counters.get('evictedBytes', 0) / mb),
+    ]
+    for fmt, decodes in sorted(stats['decodes'].items()):
+        lines.append('{0}: {1} decodes, mean {2:.1f} ms, max {3:.0f} ms'.format(
+            fmt, decodes['count'], decodes['meanMs'], decodes['maxMs']))
+    return '\n'.join(lines)
+
+
 def setVisuallyEnabled(control, enabled):
     style = '' if enabled else 'color: rgb(120, 120, 120);'
     control.setEnabled(enabled)
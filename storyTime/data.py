@@ -7,10 +7,30 @@ Created by Bohdon Sayre on 2012-03-26.
 Copyright (c) 2012 Moonbot Studios. All rights reserved.
 """
 
+from array import array
 from audio import AudioRecording
-import copy
+import bisect
+import collections
+import contextlib
 import logging
 import os
+import re
+import stat
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 LOG = logging.getLogger('storyTime.data')
 
@@ -24,10 +44,89 @@ FPS_OPTIONS = {
     60:'NTSC Field (60 fps)',
 }
 
+# the last group of digits in a filename, and the rest of the name after it
+SEQUENCE_RE = re.compile(r'^(.*?)(\d+)(\D*)$')
+# splits a path into alternating text and number parts for natural sorting
+NATURAL_SORT_RE = re.compile(r'(\d+)')
+
 DEFAULT_IMAGE_TYPES = [
     'jpg', 'jpeg', 'png', 'tif', 'tiff', 'tga', 'ico', 'gif',
 ]
 
+# seconds that a cached stat result is trusted for
+DEFAULT_STAT_TTL = 2.0
+
+def retimeRecordings(recordings, fps):
+    """
+    Convert the given FrameRecordings to a new frame rate in place.
+    
+    Cut times are converted cumulatively and rounded to the nearest frame
+    of the new rate, so the total duration and every cut point stay as
+    close as possible to the original times instead of drifting by the
+    rounding error of each frame. Every frame keeps at least one frame of
+    duration. All recordings are converted together, using NumPy when it
+    is available.
+    """
+    recordings = [r for r in recordings if r.fps != fps]
+    if len(recordings) == 0:
+        return
+    if numpy is not None:
+        durations = _retimeDurationsNumpy(recordings, fps)
+    else:
+        durations = [_retimeDurations(r._durations(), r.fps, fps) for r in recordings]
+    for r, d in zip(recordings, durations):
+        with r.batch():
+            r._record('fps', r.fps, fps, r.start)
+            r.retime(d)
+            r.start = _retimeTime(r.start, r.fps, fps)
+            r.fps = fps
+
+
+def _retimeTime(time, fps, newFps):
+    """ Convert a time in frames to the nearest frame at a new fps, rounding halves up """
+    return (time * newFps * 2 + fps) // (fps * 2)
+
+
+def _retimeDurations(durations, fps, newFps):
+    """ Retime a list of frame durations from fps to newFps """
+    new = []
+    t = 0
+    last = 0
+    for d in durations:
+        t += d
+        # each cut lands on the nearest new frame, and at least a frame after the last
+        out = max(_retimeTime(t, fps, newFps), last + 1)
+        new.append(out - last)
+        last = out
+    return new
+
+
+def _retimeDurationsNumpy(recordings, newFps):
+    """ Retime the durations of all given recordings in a single vectorized pass """
+    counts = numpy.array([len(r) for r in recordings], dtype=numpy.int64)
+    durations = numpy.concatenate([numpy.asarray(r._durations(), dtype=numpy.int64) for r in recordings] + [numpy.zeros(0, numpy.int64)])
+    # first frame of each recording within the concatenated array
+    starts = numpy.cumsum(counts) - counts
+    # cumulative out time of every frame relative to its recording
+    cum = numpy.cumsum(durations)
+    cum -= numpy.repeat(numpy.concatenate([[0], cum])[starts], counts)
+    fps = numpy.repeat(numpy.array([r.fps for r in recordings], dtype=numpy.int64), counts)
+    outTimes = (cum * newFps * 2 + fps) // (fps * 2)
+    inTimes = numpy.concatenate([[0], outTimes[:-1]])
+    inTimes[starts[counts > 0]] = 0
+    newDurations = outTimes - inTimes
+    result = []
+    for start, count in zip(starts, counts):
+        d = newDurations[start:start + count]
+        if count and d.min() < 1:
+            # keep every frame at least a frame long, pushing later cuts back only as needed
+            idx = numpy.arange(1, count + 1)
+            out = numpy.maximum.accumulate(numpy.maximum(outTimes[start:start + count] - idx, 0)) + idx
+            d = numpy.diff(numpy.concatenate([[0], out]))
+        result.append(d.tolist())
+    return result
+
+
 class FrameRecording(object):
     """
     A recording created by Story Time. Times are stored
@@ -36,42 +135,110 @@ class FrameRecording(object):
     FrameRecordings provide a pretty expansive interface for modification.
     This includes subscription and iteration akin to a list,
     eg. myRecording[4:12] to retrieve frames 4 through 12.
+    
+    A cumulative index of frame out times is kept alongside the frames
+    so that time lookups are a bisect rather than a walk of every frame.
+    The index is truncated at the first edited frame and extended again
+    lazily on the next lookup, so appends stay cheap. Frame durations
+    should be changed through `setDuration` to keep the index in sync.
+    
+    Compact recordings store their frames in a CompactFrameList rather
+    than a list of Frame objects, which is considerably smaller for
+    recordings with a large number of cuts.
+    
+    Adding or extending recordings does not copy any frames. Instead the
+    result keeps a list of segments that share the storage of the source
+    recordings, and is only flattened into its own storage when it is
+    modified. Reads resolve frames across the segments directly.
+    Recordings whose storage is shared copy it the
+    first time they are modified.
+    
+    Bulk edits (splice, retime, replaceImages, removeHolds) touch the
+    storage and the index once per call, and can be grouped further with
+    `batch`, which rebuilds the index once when the outermost batch ends.
+    
+    When a RecordingHistory is assigned to `history`, every edit is
+    recorded as a small delta that can be reverted with `undo`.
     """
-    def __init__(self, fps=24):
+    def __init__(self, fps=24, compact=False):
         self.fps = fps
         self.start = 0
-        self._frames = []
+        self.compact = compact
+        self.history = None
+        self._batchDepth = 0
+        self._reset()
     
     def __repr__(self):
-        return '<FrameRecording | {0.start}-{0.end}@{0.fps} | {1} frame(s)>'.format(self, len(self.frames))
+        return '<FrameRecording | {0.start}-{0.end}@{0.fps} | {1} frame(s)>'.format(self, len(self))
     
     def __iter__(self):
-        for f in self.frames:
-            yield f
+        if self._segments is not None:
+            for frames, count, duration in self._segments:
+                for f in frames:
+                    yield f
+        else:
+            for f in self._frames:
+                yield f
     
     def __getitem__(self, key):
         if not isinstance(key, (int, slice)):
             raise TypeError
-        return self.frames[key]
+        if isinstance(key, int):
+            return self._frameAt(key)
+        if key.step in (None, 1):
+            return self._sliceFrames(key.start, key.stop)
+        return list(self)[key]
     
     def __delitem__(self, key):
         if not isinstance(key, (int, slice)):
             raise TypeError
-        del self._frames[key]
+        frames = self._writableFrames()
+        if isinstance(key, int):
+            removed = frames[key].duration
+            start = stop = self._clampIndex(key)
+            count = 1
+        else:
+            indices = xrange(*key.indices(len(self)))
+            count = len(indices)
+            if count == 0:
+                return
+            removed = sum([f.duration for f in frames[key]])
+            start, stop = min(indices[0], indices[-1]), max(indices[0], indices[-1])
+        old = self._pairs(start, stop + 1) if self.history is not None else None
+        del frames[key]
+        self._duration -= removed
+        self._invalidate(start)
+        if old is not None:
+            self._record('splice', start, old, self._pairs(start, stop + 1 - count))
     
     def __len__(self):
+        if self._segments is not None:
+            return sum([count for frames, count, duration in self._segments])
         return len(self._frames)
     
     def __add__(self, other):
         if isinstance(other, FrameRecording):
-            new = copy.deepcopy(self)
-            for f in other:
-                new.append(f.image, f.duration)
+            new = FrameRecording(self.fps, self.compact)
+            new.start = self.start
+            new.extend(self)
+            new.extend(other)
             return new
         return NotImplemented
     
+    def __iadd__(self, other):
+        if isinstance(other, FrameRecording):
+            self.extend(other)
+            return self
+        return NotImplemented
+    
     @property
     def frames(self):
+        """
+        This recording's own frame storage. Shared segments are flattened
+        first, so iterate or index the recording instead to only read.
+        """
+        if self._segments is not None:
+            self._flatten()
         return self._frames
     
     @property
@@ -80,14 +247,51 @@ class FrameRecording(object):
     
     @property
     def duration(self):
-        return sum([f.duration for f in self.frames])
+        return self._duration
     
     @property
     def images(self):
-        return sorted(list(set([f.image for f in self.frames])))
+        return sorted(list(set([f.image for f in self])))
     
     def clear(self):
-        self._frames = []
+        if self.history is not None and len(self) > 0:
+            # the old storage is kept, and shared if restored
+            self._record('clear', self._frames, self._segments, self._duration)
+        self._reset()
+    
+    def _reset(self):
+        self._frames = self._newFrames()
+        # relative out time of each frame, valid for the first len(_outTimes) frames
+        self._outTimes = array('I') if self.compact else []
+        self._duration = 0
+        # (frames, count, duration) storage shared with other recordings
+        self._segments = None
+        # (segments, index of the first frame of each segment), see _getSegmentStarts
+        self._segmentStarts = None
+        # whether _frames is referenced by another recording's segments
+        self._shared = False
+    
+    def extend(self, other):
+        """
+        Append all frames of the given recording to this one. The frames
+        are not copied, this recording shares the other's storage until
+        either of them is modified.
+        """
+        if not isinstance(other, FrameRecording):
+            raise TypeError('expected a FrameRecording, got {0}'.format(type(other).__name__))
+        if len(other) == 0:
+            return
+        segments = other._getSegments()
+        self._record('extend', len(self), segments)
+        self._extendSegments(segments)
+    
+    def _extendSegments(self, segments):
+        segments = self._getSegments() + segments
+        self._segments = segments
+        self._frames = None
+        self._outTimes = array('I') if self.compact else []
+        self._duration = sum([duration for frames, count, duration in segments])
+        self._shared = False
     
     def append(self, image, duration):
         f = Frame(image, duration)
@@ -96,15 +300,458 @@ class FrameRecording(object):
     def appendFrame(self, f):
         if not isinstance(f, Frame):
             raise TypeError('expected a Frame, got {0}'.format(type(f).__name__))
-        self._frames.append(f)
+        if isinstance(f, FrameView):
+            # detach views, they point into another recording's storage
+            f = Frame(f.image, f.duration)
+        frames = self._writableFrames()
+        self._record('splice', len(frames), [], [(f.image, f.duration)])
+        if len(self._outTimes) == len(frames):
+            # index is up to date, extend it in place
+            self._outTimes.append(self._duration + f.duration)
+        frames.append(f)
+        self._duration += f.duration
     
     def insert(self, index, image, duration):
+        index = self._clampIndex(index)
+        if index == len(self):
+            return self.append(image, duration)
         f = Frame(image, duration)
-        self._frames.insert(index, f)
+        self._writableFrames().insert(index, f)
+        self._duration += f.duration
+        self._invalidate(index)
+        self._record('splice', index, [], [(f.image, f.duration)])
+    
+    def recordImage(self, image, time):
+        """
+        Record the given image as ending at the given absolute time.
+        The new frame starts where the frame under `time` ends, so when
+        the playhead is at the tail of the recording this is a constant
+        time append. Returns the index of the new frame, or None if the
+        frame would have no duration.
+        """
+        end = self.end
+        if time >= end:
+            # live recording, the running out time is the recording's end
+            if time == end:
+                return
+            self.append(image, time - end)
+            return len(self) - 1
+        index = self.getIndex(time)
+        index = 0 if index is None else index + 1
+        duration = time - self.outTime(index - 1)
+        if duration == 0:
+            return
+        self.insert(index, image, duration)
+        return index
     
     def pop(self, index):
-        if index < len(self.frames):
-            return self._frames.pop(index)
+        if index < len(self):
+            start = self._clampIndex(index)
+            f = self._writableFrames().pop(index)
+            self._duration -= f.duration
+            self._invalidate(start)
+            self._record('splice', start, [(f.image, f.duration)], [])
+            return f
+    
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Group several edits together. The time index is rebuilt
+        once when the outermost batch is finished.
+        
+            with recording.batch():
+                recording.retime([12, 8, 8], 4)
+                recording.removeHolds(['board_010.png'])
+        """
+        self.beginBatch()
+        try:
+            yield self
+        finally:
+            self.endBatch()
+    
+    def beginBatch(self):
+        """ Begin a batch of edits, see `batch` """
+        self._batchDepth += 1
+        if self.history is not None:
+            self.history.beginGroup()
+    
+    def endBatch(self):
+        """ End a batch of edits started with `beginBatch` """
+        if self._batchDepth == 0:
+            return
+        self._batchDepth -= 1
+        if self.history is not None:
+            self.history.endGroup()
+        if self._batchDepth == 0:
+            self._updateIndex()
+    
+    @property
+    def inBatch(self):
+        return self._batchDepth > 0
+    
+    def splice(self, start, stop, frames=()):
+        """
+        Replace the frames from start to stop with the given frames.
+        `frames` may contain Frames or (image, duration) pairs.
+        """
+        new = []
+        for f in frames:
+            if isinstance(f, FrameView):
+                # detach views, they may point into this recording
+                f = Frame(f.image, f.duration)
+            elif not isinstance(f, Frame):
+                f = Frame(*f)
+            new.append(f)
+        start, stop = slice(start, stop).indices(len(self))[:2]
+        stop = max(start, stop)
+        if self.history is not None:
+            self._record('splice', start, self._pairs(start, stop), [(f.image, f.duration) for f in new])
+        removed = sum(self._durations(start, stop))
+        self._writableFrames()[start:stop] = new
+        self._duration += sum([f.duration for f in new]) - removed
+        self._invalidate(start)
+    
+    def retime(self, durations, start=0):
+        """ Set the durations of consecutive frames beginning at start """
+        start = self._clampIndex(start)
+        durations = [max(1, int(d)) for d in durations][:len(self) - start]
+        stop = start + len(durations)
+        if stop == start:
+            return
+        old = self._durations(start, stop)
+        removed = sum(old)
+        self._record('retime', start, old, durations)
+        frames = self._writableFrames()
+        if isinstance(frames, CompactFrameList):
+            frames.durations[start:stop] = array('I', durations)
+        else:
+            frames[start:stop] = [Frame(f.image, d) for f, d in zip(frames[start:stop], durations)]
+        self._duration += sum(durations) - removed
+        self._invalidate(start)
+    
+    def replaceImages(self, images):
+        """
+        Replace images throughout the recording.
+        `images` is a dict of {oldImage:newImage}
+        """
+        images = dict([(os.path.normpath(k), os.path.normpath(v)) for k, v in images.items()])
+        frames = self._writableFrames()
+        if isinstance(frames, CompactFrameList):
+            if self.history is not None:
+                ids = set([i for i, p in enumerate(frames.paths) if p in images])
+                indices = array('I', [i for i, id_ in enumerate(frames.imageIds) if id_ in ids])
+                old = [frames.imageAt(i) for i in indices]
+            frames.replaceImages(images)
+        else:
+            indices = array('I')
+            old = []
+            for i, f in enumerate(frames):
+                if f.image in images:
+                    indices.append(i)
+                    old.append(f.image)
+                    frames[i] = Frame(images[f.image], f.duration)
+        if self.history is not None and len(indices) > 0:
+            self._record('images', indices, old, [images[i] for i in old])
+    
+    def removeHolds(self, images):
+        """
+        Remove every frame holding one of the given images.
+        Returns the number of frames removed.
+        """
+        images = set([os.path.normpath(i) for i in images])
+        indices = array('I', [i for i, f in enumerate(self) if f.image in images])
+        if len(indices) == 0:
+            return 0
+        if self.history is not None:
+            self._record('remove', indices, [(self._frameAt(i).image, self._frameAt(i).duration) for i in indices])
+        self._removeAt(indices)
+        return len(indices)
+    
+    def retimeToFps(self, fps):
+        """ Convert this recording to a new frame rate, see `retimeRecordings` """
+        retimeRecordings([self], fps)
+    
+    def consolidate(self):
+        """
+        Merge consecutive frames holding the same image into a single
+        longer frame, in one pass over the recording. Returns an array
+        mapping every old frame index to its new index.
+        """
+        images, durations = [], []
+        mapping = array('I')
+        removed, removedDurations = array('I'), array('I')
+        for i, f in enumerate(self):
+            if images and images[-1] == f.image:
+                durations[-1] += f.duration
+                removed.append(i)
+                removedDurations.append(f.duration)
+            else:
+                images.append(f.image)
+                durations.append(f.duration)
+            mapping.append(len(images) - 1)
+        if len(removed) == 0:
+            return mapping
+        self._record('merge', removed, removedDurations)
+        self._setPairs(zip(images, durations))
+        self._invalidate(removed[0] - 1)
+        return mapping
+    
+    def setDuration(self, index, duration):
+        """ Set the duration of the frame at the given index """
+        frames = self._writableFrames()
+        old = frames[index]
+        f = Frame(old.image, duration)
+        self._record('retime', self._clampIndex(index), [old.duration], [f.duration])
+        self._duration += f.duration - old.duration
+        frames[index] = f
+        self._invalidate(self._clampIndex(index))
+    
+    def undo(self):
+        """ Revert the last edit recorded in history. Returns True if anything was undone """
+        if self.history is None:
+            return False
+        return self.history.undo(self)
+    
+    def redo(self):
+        """ Reapply the last undone edit. Returns True if anything was redone """
+        if self.history is None:
+            return False
+        return self.history.redo(self)
+    
+    def _record(self, *delta):
+        if self.history is not None:
+            self.history.push(delta)
+    
+    def _applyDelta(self, delta, reverse=False):
+        """ Apply or revert a delta created by `_record` """
+        kind = delta[0]
+        if kind == 'group':
+            for d in (reversed(delta[1]) if reverse else delta[1]):
+                self._applyDelta(d, reverse)
+        elif kind == 'splice':
+            start, old, new = delta[1:]
+            if reverse:
+                old, new = new, old
+            self.splice(start, start + len(old), new)
+        elif kind == 'retime':
+            start, old, new = delta[1:]
+            self.retime(old if reverse else new, start)
+        elif kind == 'images':
+            indices, old, new = delta[1:]
+            self._setImages(indices, old if reverse else new)
+        elif kind == 'remove':
+            indices, frames = delta[1:]
+            if reverse:
+                self._insertAt(indices, frames)
+            else:
+                self._removeAt(indices)
+        elif kind == 'fps':
+            old, new, start = delta[1:]
+            if reverse:
+                self.fps, self.start = old, start
+            else:
+                self.fps, self.start = new, _retimeTime(start, old, new)
+        elif kind == 'merge':
+            if reverse:
+                self._unmerge(*delta[1:])
+            else:
+                self.consolidate()
+        elif kind == 'extend':
+            length, segments = delta[1:]
+            if reverse:
+                del self[length:]
+            else:
+                self._extendSegments(segments)
+        elif kind == 'clear':
+            if reverse:
+                self._frames, self._segments, self._duration = delta[1:]
+                self._outTimes = array('I') if self.compact else []
+                self._shared = True
+            else:
+                self._reset()
+    
+    def _pairs(self, start=0, stop=None):
+        """ Return (image, duration) pairs for the frames from start to stop """
+        return [(f.image, f.duration) for f in self._sliceFrames(start, stop)]
+    
+    def _setPairs(self, pairs):
+        """ Replace all frames with the given (image, duration) pairs """
+        frames = self._newFrames()
+        if isinstance(frames, CompactFrameList):
+            for image, duration in pairs:
+                frames.imageIds.append(frames.internImage(image))
+                frames.durations.append(duration)
+        else:
+            frames.extend([Frame(image, duration) for image, duration in pairs])
+        self._frames = frames
+        # the new storage replaces any segments shared with other recordings
+        self._segments = None
+        self._segmentStarts = None
+        self._outTimes = array('I') if self.compact else []
+        self._shared = False
+        self._duration = sum(self._durations())
+    
+    def _unmerge(self, indices, durations):
+        """ Split merged frames back out, reverting `consolidate` """
+        removed = dict(zip(indices, durations))
+        pairs = []
+        kept = iter(self._pairs())
+        survivor = None
+        for i in xrange(len(self) + len(indices)):
+            if i in removed:
+                # split the removed duration back off the frame it was merged into
+                image, duration = pairs[survivor]
+                pairs[survivor] = (image, duration - removed[i])
+                pairs.append((image, removed[i]))
+            else:
+                survivor = len(pairs)
+                pairs.append(next(kept))
+        self._setPairs(pairs)
+        self._invalidate(indices[0] - 1)
+    
+    def _setImages(self, indices, images):
+        frames = self._writableFrames()
+        for i, image in zip(indices, images):
+            frames[i] = Frame(image, frames[i].duration)
+    
+    def _removeAt(self, indices):
+        """ Remove the frames at the given ascending indices """
+        frames = self._writableFrames()
+        drop = set(indices)
+        keep = [i for i in xrange(len(frames)) if i not in drop]
+        if isinstance(frames, CompactFrameList):
+            frames.imageIds = array('I', [frames.imageIds[i] for i in keep])
+            frames.durations = array('I', [frames.durations[i] for i in keep])
+        else:
+            self._frames = [frames[i] for i in keep]
+        self._duration = sum(self._durations())
+        self._invalidate(indices[0])
+    
+    def _insertAt(self, indices, pairs):
+        """ Insert (image, duration) pairs so that they end up at the given ascending indices """
+        frames = self._writableFrames()
+        total = len(frames) + len(indices)
+        new = dict(zip(indices, pairs))
+        old = iter(xrange(len(frames)))
+        if isinstance(frames, CompactFrameList):
+            imageIds, durations = array('I'), array('I')
+            for i in xrange(total):
+                if i in new:
+                    imageIds.append(frames.internImage(new[i][0]))
+                    durations.append(new[i][1])
+                else:
+                    j = next(old)
+                    imageIds.append(frames.imageIds[j])
+                    durations.append(frames.durations[j])
+            frames.imageIds, frames.durations = imageIds, durations
+        else:
+            self._frames = [Frame(*new[i]) if i in new else frames[next(old)] for i in xrange(total)]
+        self._duration = sum(self._durations())
+        self._invalidate(indices[0])
+    
+    def _newFrames(self):
+        return CompactFrameList() if self.compact else []
+    
+    def _getSegments(self):
+        """
+        Return this recording's frames as a list of segments,
+        marking its storage as shared with the caller
+        """
+        if self._segments is not None:
+            return list(self._segments)
+        if len(self._frames) == 0:
+            return []
+        self._shared = True
+        return [(self._frames, len(self._frames), self._duration)]
+    
+    def _getSegmentStarts(self):
+        """ Return the index of the first frame of each segment """
+        if self._segmentStarts is None or self._segmentStarts[0] is not self._segments:
+            starts = []
+            total = 0
+            for frames, count, duration in self._segments:
+                starts.append(total)
+                total += count
+            self._segmentStarts = (self._segments, starts)
+        return self._segmentStarts[1]
+    
+    def _frameAt(self, index):
+        """ Return the frame at the given index, reading across segments without flattening them """
+        if self._segments is None:
+            return self._frames[index]
+        count = len(self)
+        if index < 0:
+            index += count
+        if index < 0 or index >= count:
+            raise IndexError('frame index out of range')
+        starts = self._getSegmentStarts()
+        i = bisect.bisect_right(starts, index) - 1
+        return self._segments[i][0][index - starts[i]]
+    
+    def _sliceFrames(self, start=0, stop=None):
+        """ Return a list of the frames from start to stop, reading across segments without flattening them """
+        if self._segments is None:
+            return self._frames[start:stop]
+        start, stop = slice(start, stop).indices(len(self))[:2]
+        starts = self._getSegmentStarts()
+        frames = []
+        i = max(bisect.bisect_right(starts, start) - 1, 0)
+        while i < len(starts) and starts[i] < stop:
+            segment = self._segments[i][0]
+            frames.extend(segment[max(start - starts[i], 0):stop - starts[i]])
+            i += 1
+        return frames
+    
+    def _flatten(self):
+        """ Copy all segments into new storage owned by this recording """
+        frames = self._newFrames()
+        for segment, count, duration in self._segments:
+            if isinstance(segment, CompactFrameList) and not self.compact:
+                frames.extend(segment.toFrames())
+            else:
+                frames.extend(segment)
+        self._frames = frames
+        self._segments = None
+        self._shared = False
+    
+    def _writableFrames(self):
+        """ Return this recording's storage, copying it first if it is shared """
+        if self._segments is not None:
+            self._flatten()
+        elif self._shared:
+            if isinstance(self._frames, CompactFrameList):
+                self._frames = self._frames.copy()
+            else:
+                self._frames = list(self._frames)
+            self._shared = False
+        return self._frames
+    
+    def _clampIndex(self, index):
+        """ Return the given list-style index as a positive insertion index """
+        if index < 0:
+            index += len(self)
+        return max(0, min(index, len(self)))
+    
+    def _invalidate(self, index):
+        """ Discard the out time index from the given frame index onwards """
+        del self._outTimes[index:]
+    
+    def _updateIndex(self):
+        """ Extend the out time index to cover every frame """
+        count = len(self._outTimes)
+        if count == len(self):
+            return
+        t = self._outTimes[-1] if count else 0
+        outTimes = self._outTimes
+        for d in self._durations(count):
+            t += d
+            outTimes.append(t)
+    
+    def _durations(self, start=0, stop=None):
+        """ Return the durations of the frames from start to stop """
+        if self._segments is None and isinstance(self._frames, CompactFrameList):
+            return self._frames.durations[start:stop]
+        return [f.duration for f in self._sliceFrames(start, stop)]
     
     
     def relativeTime(self, time):
@@ -123,29 +770,39 @@ class FrameRecording(object):
         if rtime < 0:
             return 0
         elif rtime >= self.duration:
-            return len(self.frames) - 1
-        t = 0
-        for i, f in enumerate(self.frames):
-            t += f.duration
-            if rtime < t:
-                return i
+            return len(self) - 1
+        self._updateIndex()
+        return bisect.bisect_right(self._outTimes, rtime)
     
     def getFrame(self, time):
         """ Return the frame at the given time """
         index = self.getIndex(time)
         if index is not None:
-            return self.frames[self.getIndex(time)]
+            return self._frameAt(index)
+    
+    def getImagesBetween(self, start, end):
+        """
+        Return the images shown from start up to end, in the
+        order they appear and without repeats
+        """
+        if len(self) == 0 or end <= start:
+            return []
+        images = []
+        for image, duration in self._pairs(self.getIndex(start), self.getIndex(end - 1) + 1):
+            if image not in images:
+                images.append(image)
+        return images
         
     def inTime(self, index):
-        if index < len(self):
-            rtime = sum([f.duration for f in self.frames[:index]])
-            return self.absoluteTime(rtime)
+        if 0 < index < len(self):
+            self._updateIndex()
+            return self.absoluteTime(self._outTimes[index - 1])
         return self.absoluteTime(0)
     
     def outTime(self, index):
-        if index < len(self):
-            rtime = sum([f.duration for f in self.frames[:index+1]])
-            return self.absoluteTime(rtime)
+        if 0 <= index < len(self):
+            self._updateIndex()
+            return self.absoluteTime(self._outTimes[index])
         return self.absoluteTime(0)
     
 
@@ -156,14 +813,20 @@ class Frame(object):
     A specific frame within a FrameRecording. Frames only care about the
     image they represent and how long that image is displayed. Their
     cut information is stored in the recording.
+    
+    Frames are immutable, since recordings share their frames with each
+    other. Edit a recording through its methods, eg. `setDuration`.
     """
     def __init__(self, image, duration):
         """
         `image` - the full path to the image this frame represents
         `duration` - the frame duration of the image, min = 1
         """
-        self.image = image
-        self.duration = duration
+        if isinstance(image, (str, unicode)):
+            self._image = os.path.normpath(image)
+        else:
+            self._image = None
+        self._duration = max(1, int(duration))
     
     def __eq__(self, other):
         if isinstance(other, Frame):
@@ -183,18 +846,11 @@ class Frame(object):
         if self._image is None:
             return ''
         return self._image
-    def setImage(self, value):
-        if isinstance(value, (str, unicode)):
-            self._image = os.path.normpath(value)
-        else:
-            self._image = None
-    image = property(getImage, setImage)
+    image = property(getImage)
     
     def getDuration(self):
         return self._duration
-    def setDuration(self, value):
-        self._duration = max(1, int(value))
-    duration = property(getDuration, setDuration)
+    duration = property(getDuration)
     
     def serialize(self):
         return {'image':self.image, 'duration':self.duration}
@@ -203,6 +859,251 @@ class Frame(object):
     def deserialize(dictonary):
         return Frame(dictonary['image'], dictonary['duration'])
 
+class FrameView(Frame):
+    """
+    A read-only Frame that reads its image and duration
+    from a position within a CompactFrameList. Views are only
+    valid until the list they came from is modified.
+    """
+    def __init__(self, frames, index):
+        self._list = frames
+        self._index = index
+    
+    @property
+    def image(self):
+        return self._list.imageAt(self._index)
+    
+    @property
+    def duration(self):
+        return self._list.durations[self._index]
+
+
+class CompactFrameList(object):
+    """
+    Array-backed frame storage for FrameRecordings. Image paths are
+    interned into a table and each frame is stored as an image id and
+    a duration in parallel arrays, which costs a few bytes per frame
+    rather than a full Frame object and path string.
+    
+    CompactFrameLists behave like a list of Frames. Frames are returned
+    as FrameViews, and any Frame can be assigned or inserted.
+    """
+    def __init__(self, frames=None):
+        self.paths = []
+        self.imageIds = array('I')
+        self.durations = array('I')
+        self._pathIds = {}
+        if frames is not None:
+            self.extend(frames)
+    
+    def __repr__(self):
+        return '<CompactFrameList {0} frame(s) | {1} image(s)>'.format(len(self), len(self.paths))
+    
+    def __len__(self):
+        return len(self.durations)
+    
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield FrameView(self, i)
+    
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [FrameView(self, i) for i in xrange(*key.indices(len(self)))]
+        return FrameView(self, self._validIndex(key))
+    
+    def __setitem__(self, index, frame):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('extended slice assignment is not supported')
+            frames = list(frame)
+            self.imageIds[start:stop] = array('I', [self.internImage(f.image) for f in frames])
+            self.durations[start:stop] = array('I', [f.duration for f in frames])
+            return
+        index = self._validIndex(index)
+        self.imageIds[index] = self.internImage(frame.image)
+        self.durations[index] = frame.duration
+    
+    def __delitem__(self, key):
+        del self.imageIds[key]
+        del self.durations[key]
+    
+    def _validIndex(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('frame index out of range')
+        return index
+    
+    def internImage(self, image):
+        """ Return the id of the given image path, adding it to the table if needed """
+        id_ = self._pathIds.get(image)
+        if id_ is None:
+            id_ = len(self.paths)
+            self.paths.append(image)
+            self._pathIds[image] = id_
+        return id_
+    
+    def replaceImages(self, images):
+        """ Replace image paths in the table using a dict of {old:new} """
+        self.paths = [images.get(p, p) for p in self.paths]
+        self._pathIds = {}
+        for id_ in reversed(xrange(len(self.paths))):
+            self._pathIds[self.paths[id_]] = id_
+    
+    def imageAt(self, index):
+        return self.paths[self.imageIds[index]]
+    
+    def append(self, frame):
+        self.imageIds.append(self.internImage(frame.image))
+        self.durations.append(frame.duration)
+    
+    def extend(self, frames):
+        if isinstance(frames, CompactFrameList):
+            # remap the other list's image ids into this table
+            ids = [self.internImage(p) for p in frames.paths]
+            self.imageIds.extend(array('I', [ids[i] for i in frames.imageIds]))
+            self.durations.extend(frames.durations)
+            return
+        for f in frames:
+            self.append(f)
+    
+    def copy(self):
+        new = CompactFrameList()
+        new.paths = list(self.paths)
+        new.imageIds = array('I', self.imageIds)
+        new.durations = array('I', self.durations)
+        new._pathIds = dict(self._pathIds)
+        return new
+    
+    def toFrames(self):
+        """ Return a list of full Frame objects for every frame """
+        paths = self.paths
+        return [Frame(paths[i], d) for i, d in zip(self.imageIds, self.durations)]
+    
+    def insert(self, index, frame):
+        self.imageIds.insert(index, self.internImage(frame.image))
+        self.durations.insert(index, frame.duration)
+    
+    def pop(self, index=-1):
+        index = self._validIndex(index)
+        f = Frame(self.imageAt(index), self.durations[index])
+        del self[index]
+        return f
+
+
+class RecordingHistory(object):
+    """
+    Undo/redo history for a FrameRecording. Edits are stored as deltas
+    describing only the frames they touched (eg. a splice keeps the
+    removed and inserted frames, a retime keeps the old and new durations)
+    so memory depends on the size of the edits, not the recording.
+    
+    The history is bounded by both a number of steps and a total number
+    of frames held by all deltas. The oldest steps are dropped first.
+    """
+    def __init__(self, maxSteps=100, maxFrames=100000):
+        self.maxSteps = maxSteps
+        self.maxFrames = maxFrames
+        self._group = None
+        self._groupDepth = 0
+        self._applying = False
+        self.clear()
+    
+    def __repr__(self):
+        return '<RecordingHistory | {0} undo, {1} redo | {2} frame(s)>'.format(len(self._undo), len(self._redo), self.size)
+    
+    @property
+    def canUndo(self):
+        return len(self._undo) > 0
+    
+    @property
+    def canRedo(self):
+        return len(self._redo) > 0
+    
+    @property
+    def size(self):
+        """ The number of frames held by all deltas """
+        return self._size
+    
+    def clear(self):
+        self._undo = collections.deque()
+        self._redo = collections.deque()
+        self._size = 0
+    
+    def beginGroup(self):
+        """ Begin collecting deltas into a single undo step """
+        if self._groupDepth == 0:
+            self._group = []
+        self._groupDepth += 1
+    
+    def endGroup(self):
+        if self._groupDepth == 0:
+            return
+        self._groupDepth -= 1
+        if self._groupDepth == 0:
+            group, self._group = self._group, None
+            if len(group) == 1:
+                self.push(group[0])
+            elif len(group) > 1:
+                self.push(('group', group))
+    
+    def push(self, delta):
+        """ Add a delta created by a FrameRecording edit """
+        if self._applying:
+            return
+        if self._group is not None:
+            self._group.append(delta)
+            return
+        self._undo.append(delta)
+        self._size += self.deltaSize(delta)
+        while self._redo:
+            self._size -= self.deltaSize(self._redo.pop())
+        self._trim()
+    
+    def undo(self, recording):
+        if not self._undo:
+            return False
+        delta = self._undo.pop()
+        self._apply(recording, delta, True)
+        self._redo.append(delta)
+        return True
+    
+    def redo(self, recording):
+        if not self._redo:
+            return False
+        delta = self._redo.pop()
+        self._apply(recording, delta, False)
+        self._undo.append(delta)
+        return True
+    
+    def _apply(self, recording, delta, reverse):
+        self._applying = True
+        try:
+            recording._applyDelta(delta, reverse)
+        finally:
+            self._applying = False
+    
+    def _trim(self):
+        while len(self._undo) > 1 and (len(self._undo) > self.maxSteps or self._size > self.maxFrames):
+            self._size -= self.deltaSize(self._undo.popleft())
+    
+    @staticmethod
+    def deltaSize(delta):
+        kind = delta[0]
+        if kind == 'group':
+            return sum([RecordingHistory.deltaSize(d) for d in delta[1]])
+        elif kind == 'splice':
+            return len(delta[2]) + len(delta[3])
+        elif kind in ('retime', 'images', 'remove', 'merge'):
+            return len(delta[2])
+        elif kind == 'extend':
+            return len(delta[2])
+        elif kind == 'clear':
+            return sum([c for f, c, d in delta[2]]) if delta[2] is not None else len(delta[1])
+        return 0
+
+
 class VideoRecording(object):
     pass
 
@@ -217,6 +1118,8 @@ class RecordingCollection(object):
     def __init__(self, name='Recording', frames=None, audio=None):
         self.name = name
         self.frames = frames if frames is not None else FrameRecording()
+        if self.frames.history is None:
+            self.frames.history = RecordingHistory()
         self.audio = audio if audio is not None else AudioRecording()
         # self.video = video if video is not None else VideoRecording()
     
@@ -231,9 +1134,9 @@ class RecordingCollection(object):
         return self.frames.duration
     
     @staticmethod
-    def fromString(recordingDict):
+    def fromString(recordingDict, compact=False):
         """ Return a new RecordingCollection using the given string """
-        fr = FrameRecording(recordingDict['fps'])
+        fr = FrameRecording(recordingDict['fps'], compact)
         for f in recordingDict['frames']:
             fr.appendFrame(Frame.deserialize(f))
         ar = AudioRecording()
@@ -242,7 +1145,7 @@ class RecordingCollection(object):
     def toString(self):
         """ Return this RecordingCollection as a serialized string """
         serializedFrames = []
-        for f in self.frames.frames:
+        for f in self.frames:
             serializedFrames.append(f.serialize())
         fps = self.frames.fps
         tempFile = self.audio.tempFile
@@ -253,6 +1156,239 @@ class RecordingCollection(object):
         return recordingDict
 
 
+def naturalSortKey(path):
+    """
+    Return a case insensitive sort key for the given path that orders
+    numbers by value, so that board2 sorts before board10
+    """
+    parts = NATURAL_SORT_RE.split(path.lower())
+    # numbers are always at odd indices
+    parts[1::2] = [int(p) for p in parts[1::2]]
+    return parts
+
+
+def findSequences(paths):
+    """
+    Find the numbered image sequences in a list of paths, such as
+    shot_0001.png, shot_0002.png, ... in a single pass over the paths.
+    Returns a list of ImageSequences and a list of the paths that are not
+    part of any sequence. Sequences may have gaps, and frames with
+    different zero padding are split into different sequences.
+    """
+    # group frame numbers by prefix and suffix
+    groups = {}
+    for path in paths:
+        path = os.path.normpath(path)
+        dir_, name = os.path.split(path)
+        match = SEQUENCE_RE.match(name)
+        if match is None:
+            groups.setdefault(path, None)
+            continue
+        prefix, digits, suffix = match.groups()
+        groups.setdefault((os.path.join(dir_, prefix), suffix), []).append(digits)
+    sequences = []
+    singles = []
+    for key, frames in groups.iteritems():
+        if frames is None:
+            singles.append(key)
+            continue
+        prefix, suffix = key
+        # zero padded frames define the paddings in use, unpadded
+        # frames join the largest padding that formats them the same
+        paddings = sorted(set([len(d) for d in frames if len(d) > 1 and d[0] == '0']))
+        byPadding = {}
+        for d in frames:
+            if len(d) > 1 and d[0] == '0':
+                padding = len(d)
+            else:
+                i = bisect.bisect_right(paddings, len(d))
+                padding = paddings[i - 1] if i > 0 else 0
+            byPadding.setdefault(padding, []).append(int(d))
+        for padding, numbers in byPadding.iteritems():
+            if len(numbers) == 1:
+                singles.append(ImageSequence(prefix, suffix, padding).path(numbers[0]))
+            else:
+                sequences.append(ImageSequence.fromFrames(prefix, suffix, padding, numbers))
+    sequences.sort(key=lambda s: s.pattern)
+    singles.sort()
+    return sequences, singles
+
+
+class ImageSequence(object):
+    """
+    A numbered image sequence, stored as a filename pattern and ranges
+    of frame numbers rather than a list of paths. Paths are built only
+    when they are accessed, so very long sequences stay cheap to load.
+    
+    Supports the read only list protocol, as well as fast lookups
+    of the index of a path within the sequence.
+    """
+    def __init__(self, prefix, suffix, padding=0, ranges=None):
+        self.prefix = prefix
+        self.suffix = suffix
+        self.padding = padding
+        # sorted, non-overlapping (first, last) frame ranges, inclusive
+        self.ranges = []
+        # index of the first frame of each range
+        self._offsets = []
+        self._length = 0
+        for first, last in (ranges or []):
+            self._offsets.append(self._length)
+            self.ranges.append((first, last))
+            self._length += last - first + 1
+    
+    @staticmethod
+    def fromFrames(prefix, suffix, padding, frames):
+        """ Create an ImageSequence from an unordered list of frame numbers """
+        ranges = []
+        for f in sorted(set(frames)):
+            if len(ranges) and ranges[-1][1] == f - 1:
+                ranges[-1][1] = f
+            else:
+                ranges.append([f, f])
+        return ImageSequence(prefix, suffix, padding, ranges)
+    
+    def __len__(self):
+        return self._length
+    
+    def __iter__(self):
+        for first, last in self.ranges:
+            for f in xrange(first, last + 1):
+                yield self.path(f)
+    
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in xrange(*key.indices(len(self)))]
+        if not isinstance(key, (int, long)):
+            raise TypeError
+        return self.path(self.frameAt(key))
+    
+    def __contains__(self, path):
+        return self.index(path) is not None
+    
+    def __repr__(self):
+        return '<ImageSequence {0} {1}>'.format(self.pattern, self.rangeString)
+    
+    @property
+    def pattern(self):
+        """ The sequence filename pattern, with # for each padded digit """
+        return '{0}{1}{2}'.format(self.prefix, '#' * max(self.padding, 1), self.suffix)
+    
+    @property
+    def rangeString(self):
+        """ The frame ranges of the sequence, eg. 1-10,12,15-20 """
+        return ','.join([str(a) if a == b else '{0}-{1}'.format(a, b) for a, b in self.ranges])
+    
+    @property
+    def frames(self):
+        for first, last in self.ranges:
+            for f in xrange(first, last + 1):
+                yield f
+    
+    def path(self, frame):
+        """ Return the path of the given frame number """
+        return '{0}{1:0{2}d}{3}'.format(self.prefix, frame, self.padding, self.suffix)
+    
+    def frame(self, path):
+        """
+        Return the frame number of the given path
+        Returns None if the path does not match the sequence pattern
+        """
+        if not path.startswith(self.prefix) or not path.endswith(self.suffix):
+            return
+        digits = path[len(self.prefix):len(path) - len(self.suffix)]
+        if not digits.isdigit():
+            return
+        frame = int(digits)
+        # only the exact padding maps back to the same file
+        if '{0:0{1}d}'.format(frame, self.padding) != digits:
+            return
+        return frame
+    
+    def frameAt(self, index):
+        """ Return the frame number at the given index of the sequence """
+        if index < 0:
+            index += self._length
+        if index < 0 or index >= self._length:
+            raise IndexError('sequence index out of range')
+        i = bisect.bisect_right(self._offsets, index) - 1
+        return self.ranges[i][0] + index - self._offsets[i]
+    
+    def index(self, path):
+        """
+        Return the index of the given path within the sequence
+        Returns None if the path is not part of the sequence
+        """
+        frame = self.frame(path)
+        if frame is None:
+            return
+        i = bisect.bisect_right(self.ranges, (frame, float('inf'))) - 1
+        if i >= 0 and frame <= self.ranges[i][1]:
+            return self._offsets[i] + frame - self.ranges[i][0]
+
+
+class StatCache(object):
+    """
+    Caches the results of os.stat by path for a short time, so that
+    checking the same images over and over, such as on every playback
+    tick, doesn't hit the filesystem each time. This matters most for
+    images on network drives.
+    
+    Entries expire after ttl seconds, and can be invalidated early when
+    the files are known to have changed. Missing files are cached too.
+    Safe to use from several threads.
+    """
+    def __init__(self, ttl=DEFAULT_STAT_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # (time cached, stat result or None) by normalized path
+        self._stats = {}
+    
+    def __len__(self):
+        return len(self._stats)
+    
+    def stat(self, path):
+        """ Return the stat result for the given path, or None if it does not exist """
+        path = os.path.normpath(path)
+        now = time.time()
+        with self._lock:
+            entry = self._stats.get(path)
+        if entry is not None and now - entry[0] < self.ttl:
+            return entry[1]
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        self.update(path, st, now)
+        return st
+    
+    def isfile(self, path):
+        st = self.stat(path)
+        return st is not None and stat.S_ISREG(st.st_mode)
+    
+    def getmtime(self, path):
+        """ Return the modification time of the given path, or None if it does not exist """
+        st = self.stat(path)
+        if st is not None:
+            return st.st_mtime
+    
+    def update(self, path, st, now=None):
+        """ Record a stat result that was already retrieved, eg. while listing a directory """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._stats[os.path.normpath(path)] = (now, st)
+    
+    def invalidate(self, paths=None):
+        """ Forget the stat results of the given paths, or of all paths """
+        with self._lock:
+            if paths is None:
+                self._stats.clear()
+                return
+            for p in paths:
+                self._stats.pop(os.path.normpath(p), None)
+
+
 class ImageCollection(object):
     """
     A collection of images to be sample from during a Story Time recording.
@@ -263,15 +1399,31 @@ class ImageCollection(object):
     image was last sampled and making it easy to get the previous/next frame.
     Collection seeking will loop both ways.
     """
-    def __init__(self, images=None, imageTypes=DEFAULT_IMAGE_TYPES):
+    def __init__(self, images=None, imageTypes=DEFAULT_IMAGE_TYPES, statCache=None):
         self.imageTypes = imageTypes
+        # shared cache of file stats, updated whenever a directory is rescanned
+        self.statCache = statCache if statCache is not None else StatCache()
         self._seek = 0
         self._images = images if images is not None else []
+        # maps each image path to its first index in the collection
+        self._indices = {}
+        self._updateIndices()
+        # cached natural sort keys by path
+        self._sortKeys = {}
+        # number of images at the start of the collection known to be in natural order
+        self._sortedCount = 0
+        # directories the images were loaded from, used for rescanning
+        self.dirs = []
+        # modification times of the images in each directory at the last rescan
+        self._mtimes = {}
     
     def __iter__(self):
         for f in self.images:
             yield f
     
+    def __contains__(self, image):
+        return self.index(image) is not None
+    
     def __getitem__(self, key):
         if not isinstance(key, (int, slice)):
             raise TypeError
@@ -280,7 +1432,13 @@ class ImageCollection(object):
     def __delitem__(self, key):
         if not isinstance(key, (int, slice)):
             raise TypeError
+        self._expandSequence()
+        if isinstance(key, slice):
+            self._sortedCount = min(self._sortedCount, key.indices(len(self._images))[0])
+        elif key % max(len(self._images), 1) < self._sortedCount:
+            self._sortedCount -= 1
         del self._images[key]
+        self._updateIndices()
     
     def __len__(self):
         return len(self._images)
@@ -288,16 +1446,29 @@ class ImageCollection(object):
     def __repr__(self):
         return '<ImageCollection {0} image(s) | @{1.seek}>'.format(len(self.images), self)
     
+    def getImageTypes(self):
+        return self._imageTypes
+    def setImageTypes(self, value):
+        self._imageTypes = value
+        # lower case extensions, cached for fast isValidImage checks
+        self._extensions = frozenset([x.strip('.').lower() for x in value])
+    imageTypes = property(getImageTypes, setImageTypes)
+    
     def getImages(self):
         return self._images
     def setImages(self, value):
         self._images = []
-        if isinstance(value, (tuple, list)):
+        if isinstance(value, ImageSequence):
+            self._images = value
+        elif isinstance(value, (tuple, list)):
             for i in value:
                 if isinstance(i, (str, unicode)) and self.isValidImage(i):
                     self._images.append(os.path.normpath(i))
         elif isinstance(value, (str, unicode)):
             self._images.append(os.path.normpath(value))
+        self._sortedCount = 0
+        self.dirs = []
+        self._updateIndices()
     images = property(getImages, setImages)
     
     def getSeek(self):
@@ -318,20 +1489,24 @@ class ImageCollection(object):
             return value % len(self._images)
     
     def isValidImage(self, image):
-        types = [x.strip('.').lower() for x in self.imageTypes]
         ext = os.path.splitext(image)[1].strip('.')
-        return ext.lower() in types
+        return ext.lower() in self._extensions
     
     def clear(self):
         self._images = []
+        self._indices = {}
+        self._sortedCount = 0
+        self.dirs = []
+        self._mtimes = {}
     
     def index(self, image):
         """
         Return the index of the given image within the collection
         Returns None if the image is not in the collection
         """
-        if os.path.normpath(image) in self:
-            return self.images.index(os.path.normpath(image))
+        if self.isSequence:
+            return self._images.index(os.path.normpath(image))
+        return self._indices.get(os.path.normpath(image))
     
     def append(self, image):
         """
@@ -339,34 +1514,215 @@ class ImageCollection(object):
         This is like a combined append/extend functionality.
         """
         if isinstance(image, (str, unicode)):
-            self._images.append(os.path.normpath(image))
-        elif isinstance(image, (list, tuple)):
-            self._images.extend([os.path.normpath(i) for i in image])
+            image = [image]
+        elif not isinstance(image, (list, tuple)):
+            return
+        self._expandSequence()
+        for i in image:
+            i = os.path.normpath(i)
+            self._indices.setdefault(i, len(self._images))
+            self._images.append(i)
     
     def extend(self, images):
         self.append(images)
     
     def loadDir(self, dir_, additive=False):
-        if not os.path.isdir(dir_):
-            raise OSError('directory does not exist: {0}'.format(dir_))
-        files = os.listdir(dir_)
-        imgs = [os.path.join(dir_, i) for i in files if self.isValidImage(i)]
+        imgs = []
+        for batch in self.iterDir(dir_):
+            imgs.extend(batch)
         if additive:
-            self.images.extend(imgs)
+            self.extend(imgs)
         else:
             self.images = imgs
+        self.addDir(dir_)
         self.sort()
     
+    def addDir(self, dir_):
+        """ Add a directory to the list of directories this collection was loaded from """
+        dir_ = os.path.normpath(dir_)
+        if dir_ not in self.dirs:
+            self.dirs.append(dir_)
+    
+    def iterDir(self, dir_, batchSize=500):
+        """
+        Yield the valid images in the given directory in batches
+        of at most batchSize, in directory listing order.
+        Uses scandir when available to avoid a stat call per file.
+        """
+        if not os.path.isdir(dir_):
+            raise OSError('directory does not exist: {0}'.format(dir_))
+        batch = []
+        if scandir is not None:
+            entries = (e.path for e in scandir(dir_) if self.isValidImage(e.name) and e.is_file())
+        else:
+            entries = (os.path.join(dir_, f) for f in os.listdir(dir_) if self.isValidImage(f))
+        for path in entries:
+            batch.append(path)
+            if len(batch) >= batchSize:
+                yield batch
+                batch = []
+        if len(batch):
+            yield batch
+    
+    def statDir(self, dir_):
+        """ Return a dict of the modification times of the valid images in a directory """
+        mtimes = {}
+        if scandir is not None:
+            for e in scandir(dir_):
+                if self.isValidImage(e.name) and e.is_file():
+                    path = os.path.normpath(e.path)
+                    st = e.stat()
+                    self.statCache.update(path, st)
+                    mtimes[path] = st.st_mtime
+        else:
+            for f in os.listdir(dir_):
+                if not self.isValidImage(f):
+                    continue
+                path = os.path.normpath(os.path.join(dir_, f))
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                self.statCache.update(path, st)
+                if stat.S_ISREG(st.st_mode):
+                    mtimes[path] = st.st_mtime
+        return mtimes
+    
+    def rescanDir(self, dir_, mtimes=None):
+        """
+        Update the collection with any images that were added to or
+        removed from the given directory. Returns lists of the added,
+        removed and modified images. Modified images are found by
+        comparing to the modification times from the previous rescan.
+        
+        `mtimes` -- the result of statDir for the directory, if it was
+            already scanned, eg. on another thread
+        """
+        dir_ = os.path.normpath(dir_)
+        if mtimes is None:
+            try:
+                mtimes = self.statDir(dir_)
+            except OSError:
+                # treat a missing directory as empty
+                mtimes = {}
+        previous = self._mtimes.get(dir_, {})
+        self._mtimes[dir_] = mtimes
+        existing = set([i for i in self._images if os.path.dirname(i) == dir_])
+        added = [p for p in mtimes if p not in existing]
+        removed = [p for p in existing if p not in mtimes]
+        touched = [p for p, m in mtimes.iteritems() if p in previous and previous[p] != m]
+        self.statCache.invalidate(removed)
+        if len(added) or len(removed):
+            image = self.current()
+            self._removeImages(removed)
+            self.extend(added)
+            self.sort()
+            if image is not None:
+                self.seekToImage(image)
+        return added, removed, touched
+    
+    def _removeImages(self, images):
+        """ Remove all occurrences of the given images, keeping the order of the rest """
+        images = set(images)
+        if not len(images):
+            return
+        self._expandSequence()
+        kept = []
+        sortedCount = 0
+        for i, image in enumerate(self._images):
+            if image not in images:
+                kept.append(image)
+                if i < self._sortedCount:
+                    sortedCount += 1
+        self._images = kept
+        self._sortedCount = sortedCount
+        self._updateIndices()
+    
+    @property
+    def isSequence(self):
+        """ Whether the collection holds a single unexpanded ImageSequence """
+        return isinstance(self._images, ImageSequence)
+    
     def loadSequence(self, image):
-        """ Load the image sequence associated with the given image """
-        LOG.warning('loadSequence not yet implemented')
-        self._images = image
+        """
+        Load the image sequence associated with the given image,
+        and seek to the image. Loads only the image if it is not
+        part of a sequence. Returns the loaded ImageSequence, if any.
+        """
+        image = os.path.normpath(image)
+        paths = []
+        for batch in self.iterDir(os.path.dirname(image)):
+            paths.extend(batch)
+        sequences, singles = findSequences(paths)
+        for seq in sequences:
+            if image in seq:
+                LOG.debug('Loaded image sequence {0!r}'.format(seq))
+                self.images = seq
+                self.seekToImage(image)
+                return seq
+        self.images = [image]
+    
+    def _expandSequence(self):
+        """ Convert a loaded ImageSequence to a plain list of images before editing """
+        if self.isSequence:
+            self._images = list(self._images)
+            # sequences are always in natural order
+            self._sortedCount = len(self._images)
+            self._updateIndices()
     
     def sort(self, cmp_=None, key=None, reverse=False):
-        if cmp_ is None:
-            # case insensitive sort
-            cmp_ = lambda x,y: cmp(x.lower(), y.lower())
-        self._images.sort(cmp=cmp_, key=key, reverse=reverse)
+        """
+        Sort the collection. Uses a case insensitive natural sort when no
+        cmp_ or key is given. Natural sorting reuses cached keys, and only
+        sorts images added since the last natural sort before merging
+        them into the already sorted images.
+        """
+        if cmp_ is not None or key is not None:
+            self._expandSequence()
+            self._images.sort(cmp=cmp_, key=key, reverse=reverse)
+            self._sortedCount = 0
+            self._updateIndices()
+            return
+        if self.isSequence and not reverse:
+            # sequences are already in natural order
+            return
+        self._expandSequence()
+        if reverse:
+            self._images.sort(key=self.sortKey, reverse=True)
+            self._sortedCount = 0
+        elif self._sortedCount < len(self._images):
+            sortedCount = self._sortedCount
+            self._images[sortedCount:] = sorted(self._images[sortedCount:], key=self.sortKey)
+            if sortedCount > 0:
+                # the list is now two sorted runs, which timsort merges in linear time
+                self._images.sort(key=self.sortKey)
+            self._sortedCount = len(self._images)
+        else:
+            return
+        self._pruneSortKeys()
+        self._updateIndices()
+    
+    def sortKey(self, image):
+        """ Return the cached natural sort key for the given image """
+        try:
+            return self._sortKeys[image]
+        except KeyError:
+            key = self._sortKeys[image] = naturalSortKey(image)
+            return key
+    
+    def _pruneSortKeys(self):
+        """ Drop cached sort keys of images that are no longer in the collection """
+        if len(self._sortKeys) > 2 * len(self._images) + 1000:
+            self._sortKeys = dict([(i, self.sortKey(i)) for i in self._images])
+    
+    def _updateIndices(self):
+        """ Rebuild the image to index lookup after the image list was reordered """
+        self._indices = {}
+        if self.isSequence:
+            # sequences look up indices from the path itself
+            return
+        for i, image in enumerate(self._images):
+            self._indices.setdefault(image, i)
     
     def current(self):
         if len(self.images) == 0:
@@ -0,0 +1,200 @@
+"""
+journal.py
+
+Copyright (c) 2012 Moonbot Studios. All rights reserved.
+
+Provides an append-only journal of the frames recorded during a take,
+so that a recording can be recovered if Story Time exits before the
+take is stopped and saved.
+"""
+
+from data import FrameRecording, RecordingCollection
+import json
+import logging
+import os
+import Queue
+import socket
+import threading
+import time
+import utils
+
+LOG = logging.getLogger('storyTime.journal')
+
+JOURNAL_EXT = '.stj'
+
+# queued to the writer thread to write and sync any pending records
+_FLUSH = object()
+
+
+class RecordingJournal(object):
+    """
+    An append-only journal for a single recording take.
+
+    The first line of the journal is a header describing the recording
+    and the process writing it, and every recorded cut is appended as a
+    small [index, image, duration] line.
+
+    Records are written and synced to disk on a background thread, so a
+    slow disk, such as a network home directory, never stalls recording.
+    Records are written in batches, either every `flushCount` records or
+    every `flushInterval` seconds, so a checkpoint never costs more than
+    a few lines of output.
+    """
+    def __init__(self, filename, flushCount=8, flushInterval=1.0):
+        self.filename = filename
+        self.flushCount = flushCount
+        self.flushInterval = flushInterval
+        self._fp = None
+        self._queue = None
+        self._thread = None
+
+    def __repr__(self):
+        return '<RecordingJournal {0!r}>'.format(self.filename)
+
+    @property
+    def isOpen(self):
+        return self._thread is not None
+
+    def open(self, recording):
+        """ Start the journal for the given RecordingCollection """
+        dir_ = os.path.dirname(self.filename)
+        if not os.path.isdir(dir_):
+            os.makedirs(dir_)
+        self._fp = open(self.filename, 'ab')
+        header = {
+            'name':recording.name,
+            'fps':recording.frames.fps,
+            'start':recording.frames.start,
+            'audioFile':recording.audio.tempFile,
+            'pid':os.getpid(),
+            'host':socket.gethostname(),
+        }
+        self._queue = Queue.Queue()
+        self._queue.put(json.dumps(header))
+        self._queue.put(_FLUSH)
+        self._thread = threading.Thread(target=self._run, name='RecordingJournal')
+        self._thread.daemon = True
+        self._thread.start()
+        LOG.debug('Opened recording journal: {0}'.format(self.filename))
+
+    def write(self, index, image, duration):
+        """ Record a frame that was inserted at the given index """
+        if not self.isOpen:
+            return
+        self._queue.put(json.dumps([index, image, duration]))
+
+    def flush(self):
+        """ Write and sync all pending records in the background """
+        if self.isOpen:
+            self._queue.put(_FLUSH)
+
+    def close(self, remove=True):
+        """
+        Close the journal, waiting for pending records to be written.
+        The journal is removed by default, as it should only be closed
+        once the recording has been saved.
+        """
+        if not self.isOpen:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._queue = None
+        if remove:
+            removeJournal(self.filename)
+
+    def _run(self):
+        """ Write queued records until the journal is closed """
+        pending = []
+        lastSync = time.time()
+        while True:
+            if pending:
+                timeout = max(self.flushInterval - (time.time() - lastSync), 0)
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except Queue.Empty:
+                    item = _FLUSH
+            else:
+                item = self._queue.get()
+            if item is None:
+                self._write(pending)
+                self._fp.close()
+                self._fp = None
+                return
+            if item is not _FLUSH:
+                pending.append(item)
+            if item is _FLUSH or len(pending) >= self.flushCount or time.time() - lastSync >= self.flushInterval:
+                self._write(pending)
+                pending = []
+                lastSync = time.time()
+
+    def _write(self, lines):
+        try:
+            if lines:
+                self._fp.write('\n'.join(lines) + '\n')
+            self._fp.flush()
+            try:
+                os.fsync(self._fp.fileno())
+            except OSError:
+                pass
+        except (IOError, OSError) as e:
+            LOG.error('Unable to write recording journal {0}: {1}'.format(self.filename, e))
+
+
+def readJournal(filename, compact=False):
+    """
+    Rebuild a RecordingCollection from the given journal.
+    Returns a tuple of (recording, audioFile), the audio file being
+    the temporary file audio was being recorded to, if it still exists.
+    A partially written last line is ignored.
+    """
+    with open(filename, 'rb') as fp:
+        lines = fp.read().split('\n')
+    header = json.loads(lines[0])
+    frames = FrameRecording(header['fps'], compact)
+    frames.start = header['start']
+    for line in lines[1:]:
+        if not line.strip():
+            continue
+        try:
+            index, image, duration = json.loads(line)
+        except ValueError:
+            LOG.warning('skipping incomplete journal record in {0}'.format(filename))
+            continue
+        frames.insert(index, image, duration)
+    recording = RecordingCollection(header['name'], frames)
+    audioFile = header.get('audioFile')
+    if audioFile is None or not os.path.isfile(audioFile) or os.path.getsize(audioFile) == 0:
+        audioFile = None
+    return recording, audioFile
+
+
+def isJournalLive(filename):
+    """
+    Return whether the given journal is still being written by a running
+    Story Time, on this machine or another one sharing the directory.
+    Journals from other machines are left for that machine to recover.
+    """
+    with open(filename, 'rb') as fp:
+        header = json.loads(fp.readline())
+    pid = header.get('pid')
+    if pid is None:
+        # written before journals recorded their owner
+        return False
+    if header.get('host') != socket.gethostname():
+        return True
+    return pid != os.getpid() and utils.isProcessRunning(pid)
+
+
+def findJournals(dir_):
+    """ Return all journals left in the given directory """
+    if not os.path.isdir(dir_):
+        return []
+    return sorted([os.path.join(dir_, f) for f in os.listdir(dir_) if f.endswith(JOURNAL_EXT)])
+
+
+def removeJournal(filename):
+    try:
+        os.remove(filename)
+    except OSError as e:
+        LOG.warning('Could not remove journal {0}: {1}'.format(filename, e))
@@ -8,9 +8,16 @@ Copyright (c) 2012 Moonbot Studios. All rights reserved.
 from data import *
 from PySide.QtCore import *
 from PySide.QtGui import *
-import audio, utils, fcpxml
+import audio, utils, fcpxml, journal, proxies, workers
+import atexit
+import bisect
+import collections
+import contextlib
+import json
 import logging
 import math
+import mmap
+import multiprocessing
 import os
 import tempfile
 import shutil
@@ -18,6 +25,8 @@ import pdb
 import subprocess
 import sys
 import pickle
+import threading
+import time
 
 LOG = logging.getLogger('storyTime.models')
 
@@ -29,6 +38,24 @@ Mappings = utils.enum(
     'end',
 )
 
+# mappings holding the displayed pixmaps
+PIXMAP_MAPPINGS = (
+    Mappings.curImage, Mappings.prevImage, Mappings.nextImage,
+)
+
+# mappings updated together by the model's *DataChanged methods
+IMAGE_MAPPINGS = (
+    Mappings.imageCount, Mappings.curImageIndex, Mappings.curImageIndexLabel,
+    Mappings.curImagePath, Mappings.curImage, Mappings.prevImage, Mappings.nextImage,
+)
+RECORDING_MAPPINGS = (
+    Mappings.recordingIndex, Mappings.recordingName, Mappings.recordingFps,
+    Mappings.recordingDuration, Mappings.recordingDurationDisplay, Mappings.recordingImageCount,
+)
+TIME_MAPPINGS = (
+    Mappings.curTime, Mappings.timeDisplay,
+)
+
 if sys.platform in ('win32', 'win64'):
     FFMPEG = "bin\\windows\\ffmpeg.exe".replace("/","\\")
     print "Windows FFMPEG: {0}".format(FFMPEG) # TESTING
@@ -39,42 +66,553 @@ elif sys.platform == 'linux':
     FFMPEG = os.path.abspath("bin/linux/ffmpeg")
     print "Linux FFMPEG: {0}".format(FFMPEG) # TESTING
 
-class PixmapCache(object):
+# directory watchers don't report changes to existing files on linux,
+# so watched image directories are also polled for modification times
+POLL_IMAGE_DIRS = sys.platform.startswith('linux')
+POLL_INTERVAL = 3000
+
+# image types that are slow to decode, and are decoded in worker processes
+PROCESS_IMAGE_TYPES = ('tif', 'tiff', 'tga')
+# seconds to wait for a worker process before decoding on a thread instead
+PROCESS_DECODE_TIMEOUT = 30
+
+# largest dimension that images are decoded at for display, from smallest
+# to largest. None is full resolution
+RESOLUTION_TIERS = (256, 512, 1024, 2048, None)
+
+# format name used in decode statistics for images read from the proxy cache
+PROXY_FORMAT = 'proxy'
+# upper bounds in milliseconds of the decode time histogram buckets,
+# slower decodes are counted in a final bucket
+DECODE_TIME_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# pixmap cache budget used when available memory cannot be determined
+DEFAULT_CACHE_BYTES = 512 * 1024 ** 2
+# share of available memory used by an automatically sized pixmap cache
+AUTO_CACHE_FRACTION = 0.25
+MIN_CACHE_BYTES = 128 * 1024 ** 2
+# a 32 bit process runs out of address space long before physical memory
+MAX_CACHE_BYTES = (8 if sys.maxsize > 2 ** 32 else 1) * 1024 ** 3
+
+
+def getResolutionTier(size):
+    """ Return the smallest resolution tier for an image displayed at the given size in pixels """
+    for tier in RESOLUTION_TIERS:
+        if tier is None or tier >= size:
+            return tier
+
+
+def getImageFormat(path):
+    """ Return the format of the given image for decode statistics, by its extension """
+    return os.path.splitext(path)[-1][1:].lower()
+
+def coversTier(tier, other):
+    """ Return whether an image decoded at tier is large enough to display at other """
+    return tier is None or (other is not None and tier >= other)
+
+
+def decodeImage(path, tier=None, proxyCache=None, stats=None):
+    """
+    Decode the given image into a QImage that fits within the given
+    resolution tier. The image is scaled while it is decoded, which
+    is much faster for formats that support it, such as jpeg.
+    
+    If a ProxyCache is given, scaled images are read from and saved
+    to it, so they don't need to be decoded from the source again.
+    Images already within the tier are never saved as proxies.
+    If a CacheStats is given, the decode time is recorded in it.
+    """
+    useProxy = proxyCache is not None and tier is not None
+    if useProxy:
+        proxy = proxyCache.get(path, tier)
+        if proxy is not None:
+            start = time.time()
+            image = QImage(proxy)
+            if not image.isNull():
+                if stats is not None:
+                    stats.recordDecode(PROXY_FORMAT, time.time() - start)
+                return image
+    start = time.time()
+    reader = QImageReader(path)
+    scaled = False
+    if tier is not None:
+        size = reader.size()
+        if size.isValid() and max(size.width(), size.height()) > tier:
+            reader.setScaledSize(size.scaled(tier, tier, Qt.KeepAspectRatio))
+            scaled = True
+    image = reader.read()
+    if stats is not None:
+        stats.recordDecode(getImageFormat(path), time.time() - start)
+    if useProxy and scaled and not image.isNull():
+        proxyCache.put(path, tier, image)
+    return image
+
+
+class DecodeJob(QRunnable):
+    """ Decodes a single image into a QImage on an ImageDecoder's thread pool """
+    def __init__(self, decoder, path, tier=None, prefetch=False, priority=0):
+        super(DecodeJob, self).__init__()
+        self.decoder = decoder
+        self.path = path
+        self.tier = tier
+        self.prefetch = prefetch
+        self.priority = priority
+        self.generation = decoder.prefetchGeneration
+    
+    @property
+    def key(self):
+        return (self.path, self.tier)
+    
+    @property
+    def isStale(self):
+        """ Whether this is a prefetch that was cancelled before it started """
+        return self.prefetch and self.generation != self.decoder.prefetchGeneration
+    
+    def run(self):
+        if self.isStale:
+            self.decoder._jobDone.emit(self, None)
+            return
+        try:
+            image = decodeImage(self.path, self.tier, self.decoder.proxyCache, self.decoder.stats)
+        except Exception as e:
+            LOG.warning('Could not decode {0}: {1}'.format(self.path, e))
+            image = QImage()
+        self.decoder._jobDone.emit(self, image)
+
+
+class ProcessDecodeJob(DecodeJob):
+    """
+    Decodes a single image in one of an ImageDecoder's worker processes.
+    Jobs are started in the order they are requested, and cannot be
+    cancelled once started.
+    """
+    # time the job was started, to detect results that never arrive
+    started = None
+    # whether the job took too long and was decoded on a thread instead
+    timedOut = False
+    
+    def start(self):
+        proxy = None
+        quality = 90
+        proxyCache = self.decoder.proxyCache
+        if proxyCache is not None and self.tier is not None:
+            proxy = proxyCache.getProxyPath(self.path, self.tier)
+            quality = proxyCache.quality
+        args = (self.path, self.tier, self.decoder.bufferDir, proxy, quality)
+        self.started = time.time()
+        self.decoder.processPool.apply_async(workers.decodeToBuffer, args, callback=self.finished)
+    
+    def finished(self, result):
+        # called on the process pool's result thread
+        self.decoder._processJobDone.emit(self, result)
+
+
+class ImageDecoder(QObject):
+    """
+    Decodes images on a pool of worker threads so that loading
+    large images doesn't stall the GUI thread. Requests for an image
+    that is already being decoded are coalesced, and decoded QImages
+    are delivered through imageDecoded on the decoder's own thread.
+    
+    Images can also be decoded in a pool of worker processes, which
+    scales better for formats that are slow to decode, such as large
+    tiffs, and for bulk jobs. Decoded pixels are passed back through
+    shared memory and mapped as a QImage without copying. Requires PIL,
+    otherwise all images are decoded on threads. Images that PIL can't
+    decode, or whose worker doesn't answer within processTimeout seconds,
+    are decoded again on a thread.
+    
+    Prefetch requests are cancelled together with cancelPrefetch, which
+    starts a new prefetch generation. Queued jobs from an older generation
+    are skipped when a worker picks them up.
+    """
+    # path, resolution tier, QImage
+    imageDecoded = Signal(object, object, object)
+    # emitted from the worker threads, and queued to the decoder's thread
+    _jobDone = Signal(object, object)
+    # emitted from the process pool's result thread
+    _processJobDone = Signal(object, object)
+    
+    def __init__(self, maxThreads=None, proxyCache=None, maxProcesses=None, stats=None, parent=None):
+        """
+        `maxProcesses` -- the number of worker processes to decode with,
+            None for one per core, or 0 to only decode on threads
+        `stats` -- a CacheStats to record decode times in
+        """
+        super(ImageDecoder, self).__init__(parent)
+        # optional ProxyCache for images decoded at a resolution tier
+        self.proxyCache = proxyCache
+        self.stats = stats if stats is not None else CacheStats()
+        self.pool = QThreadPool(self)
+        if maxThreads is not None:
+            self.pool.setMaxThreadCount(maxThreads)
+        self.maxProcesses = maxProcesses
+        # image types that are decoded in worker processes by default
+        self.processImageTypes = PROCESS_IMAGE_TYPES
+        # created when first needed, since starting processes is slow
+        self._processPool = None
+        self._bufferDir = None
+        # pixel buffers that could not be removed while mapped
+        self._staleBuffers = []
+        # jobs by path and tier, for images that are being decoded
+        self._pending = {}
+        self.prefetchGeneration = 0
+        self._jobDone.connect(self._finishJob)
+        self._processJobDone.connect(self._finishProcessJob)
+        self.processTimeout = PROCESS_DECODE_TIMEOUT
+        # checks for process jobs whose result was lost, eg. to a crashed worker
+        self.processTimer = QTimer(self)
+        self.processTimer.setInterval(1000)
+        self.processTimer.timeout.connect(self.checkProcessJobs)
+    
+    @property
+    def canUseProcesses(self):
+        return self.maxProcesses != 0 and workers.isAvailable()
+    
+    @property
+    def processPool(self):
+        if self._processPool is None:
+            self._processPool = workers.createPool(self.maxProcesses)
+            atexit.register(self.close)
+        return self._processPool
+    
+    @property
+    def bufferDir(self):
+        if self._bufferDir is None:
+            self._bufferDir = workers.getBufferDir()
+        return self._bufferDir
+    
+    def getWorkerCount(self, process=False):
+        """ Return the number of images that can be decoded at once """
+        if process and self.canUseProcesses:
+            if self.maxProcesses is not None:
+                return self.maxProcesses
+            return multiprocessing.cpu_count()
+        return self.pool.maxThreadCount()
+    
+    def isPending(self, path, tier=None):
+        job = self._pending.get((path, tier))
+        return job is not None and not job.isStale
+    
+    def useProcessFor(self, path):
+        """ Return whether the given image is decoded in a worker process by default """
+        ext = os.path.splitext(path)[-1][1:].lower()
+        return ext in self.processImageTypes
+    
+    def request(self, path, priority=0, prefetch=False, tier=None, process=None):
+        """
+        Start decoding the given image at a resolution tier, unless it is
+        already being decoded. Jobs with a higher priority are started first.
+        Returns True if a new decode was started.
+        
+        `process` -- whether to decode in a worker process instead of a thread,
+            or None to decide by the image type
+        """
+        job = self._pending.get((path, tier))
+        if job is not None and not job.isStale:
+            if not prefetch:
+                # the image is needed now, so the job must not be cancelled
+                job.prefetch = False
+            return False
+        if process is None:
+            process = self.useProcessFor(path)
+        if process and self.canUseProcesses:
+            job = ProcessDecodeJob(self, path, tier, prefetch, priority)
+            self._pending[job.key] = job
+            job.start()
+            if not self.processTimer.isActive():
+                self.processTimer.start()
+        else:
+            self._startThreadJob(DecodeJob(self, path, tier, prefetch, priority))
+        return True
+    
+    def _startThreadJob(self, job):
+        self._pending[job.key] = job
+        self.pool.start(job, job.priority)
+    
+    def _decodeOnThread(self, processJob):
+        """ Decode the image of a failed process job on a thread instead """
+        job = DecodeJob(self, processJob.path, processJob.tier, processJob.prefetch, processJob.priority)
+        # a cancelled prefetch stays cancelled
+        job.generation = processJob.generation
+        self._startThreadJob(job)
+    
+    def checkProcessJobs(self):
+        """
+        Decode images on a thread if their worker process has not
+        answered within processTimeout seconds
+        """
+        now = time.time()
+        running = False
+        for job in self._pending.values():
+            if not isinstance(job, ProcessDecodeJob):
+                continue
+            if now - job.started < self.processTimeout:
+                running = True
+                continue
+            LOG.warning('Worker process did not decode {0} in time, decoding on a thread'.format(job.path))
+            job.timedOut = True
+            self._decodeOnThread(job)
+        if not running:
+            self.processTimer.stop()
+    
+    def cancelPrefetch(self):
+        """ Cancel all prefetch jobs that have not started yet """
+        self.prefetchGeneration += 1
+    
+    def waitForDone(self):
+        self.pool.waitForDone()
+    
+    def close(self):
+        """ Stop the worker processes and remove any leftover pixel buffers """
+        if self._processPool is not None:
+            self._processPool.terminate()
+            self._processPool = None
+        if self._bufferDir is not None:
+            shutil.rmtree(self._bufferDir, ignore_errors=True)
+            self._bufferDir = None
+    
+    def mapBuffer(self, result):
+        """ Return a QImage of the pixels decoded by a worker process """
+        path = result['buffer']
+        with open(path, 'r+b') as fp:
+            # a private mapping, which shares the pages until written to
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+        self._staleBuffers.append(path)
+        self._removeStaleBuffers()
+        fmt = QImage.Format_ARGB32 if result['hasAlpha'] else QImage.Format_RGB888
+        image = QImage(buf, result['width'], result['height'], result['bytesPerLine'], fmt)
+        # the image does not own its pixels, so keep the mapping alive with it
+        image._buffer = buf
+        return image
+    
+    def _removeStaleBuffers(self):
+        # mapped files can't be removed on windows, so keep trying
+        for path in list(self._staleBuffers):
+            try:
+                os.remove(path)
+            except OSError:
+                if os.path.exists(path):
+                    continue
+            self._staleBuffers.remove(path)
+    
+    def _finishProcessJob(self, job, result):
+        if 'error' in result:
+            # eg. a 16 bit tiff that PIL can't read, but Qt can
+            LOG.debug('Worker process could not decode {0}, decoding on a thread: {1}'.format(job.path, result['error']))
+            if not job.timedOut:
+                self._decodeOnThread(job)
+            return
+        if result['proxyBytes'] and self.proxyCache is not None:
+            self.proxyCache.added(result['proxyBytes'])
+        fmt = PROXY_FORMAT if result['fromProxy'] else getImageFormat(job.path)
+        self.stats.recordDecode(fmt, result['decodeTime'])
+        if job.timedOut:
+            # already decoded on a thread
+            self._staleBuffers.append(result['buffer'])
+            self._removeStaleBuffers()
+            return
+        try:
+            image = self.mapBuffer(result)
+        except (IOError, OSError, ValueError) as e:
+            LOG.warning('Could not read decoded pixels of {0}, decoding on a thread: {1}'.format(job.path, e))
+            self._decodeOnThread(job)
+            return
+        self._finishJob(job, image)
+    
+    def _finishJob(self, job, image):
+        if self._pending.get(job.key) is job:
+            del self._pending[job.key]
+        if image is not None:
+            self.imageDecoded.emit(job.path, job.tier, image)
+
+
+class CacheStats(object):
+    """
+    Counters for how the pixmap cache is used, and histograms of how long
+    images take to decode by format, for sizing the cache and prefetching
+    from real sessions. Decodes are recorded from worker threads as well.
+    
+    Counters:
+    `hits` -- images displayed from the cache
+    `lowerTierHits` -- images displayed at a lower resolution while decoding
+    `misses` -- images displayed that had to be decoded
+    `prefetchHits`, `prefetchMisses` -- prefetched images already cached, or not
+    `evictions`, `evictedBytes` -- pixmaps removed to stay within the budget
+    """
     def __init__(self):
-        self.maxCount = 150
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        with self._lock:
+            self.counters = collections.defaultdict(int)
+            # [count, total seconds, max seconds, bucket counts] by format
+            self.decodeTimes = {}
+            self.peakBytes = 0
+            self.startTime = time.time()
+    
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+    
+    def recordBytes(self, bytes):
+        """ Record the current size of the cache, to track its peak """
+        if bytes > self.peakBytes:
+            self.peakBytes = bytes
+    
+    def recordDecode(self, fmt, seconds):
+        """ Record the time taken to decode an image of the given format """
+        ms = seconds * 1000
+        bucket = bisect.bisect_left(DECODE_TIME_BUCKETS, ms)
+        with self._lock:
+            if fmt not in self.decodeTimes:
+                self.decodeTimes[fmt] = [0, 0.0, 0.0, [0] * (len(DECODE_TIME_BUCKETS) + 1)]
+            times = self.decodeTimes[fmt]
+            times[0] += 1
+            times[1] += seconds
+            times[2] = max(times[2], seconds)
+            times[3][bucket] += 1
+    
+    @property
+    def hitRate(self):
+        """ The fraction of displayed images that were cached at the needed resolution """
+        total = self.counters['hits'] + self.counters['misses']
+        if total:
+            return self.counters['hits'] / float(total)
+    
+    def toDict(self):
+        """ Return the statistics as a dict of plain values, eg. for saving as json """
+        labels = ['<={0}ms'.format(b) for b in DECODE_TIME_BUCKETS]
+        labels.append('>{0}ms'.format(DECODE_TIME_BUCKETS[-1]))
+        with self._lock:
+            decodes = {}
+            for fmt, (count, total, longest, buckets) in self.decodeTimes.items():
+                decodes[fmt] = {
+                    'count':count,
+                    'meanMs':total * 1000 / count,
+                    'maxMs':longest * 1000,
+                    'histogram':collections.OrderedDict(zip(labels, buckets)),
+                }
+            return {
+                'seconds':time.time() - self.startTime,
+                'counters':dict(self.counters),
+                'hitRate':self.hitRate,
+                'peakBytes':self.peakBytes,
+                'decodes':decodes,
+            }
+
+
+def getAutoCacheBytes():
+    """ Return a pixmap cache budget based on the available system memory """
+    available = utils.getAvailableMemory()
+    if available is None:
+        return DEFAULT_CACHE_BYTES
+    return int(min(max(available * AUTO_CACHE_FRACTION, MIN_CACHE_BYTES), MAX_CACHE_BYTES))
+
+
+class PixmapCache(object):
+    """
+    A least recently used cache of pixmaps by image path. Pixmaps are
+    kept in order of use, and reading a pixmap marks it as most recently
+    used, so the pixmaps evicted first are the ones not seen for longest.
+    
+    The cache is limited by the decoded size of its pixmaps rather than
+    their count. The budget is sized from available memory by default.
+    
+    Each image may be cached at several resolution tiers, see
+    RESOLUTION_TIERS. A request for a tier is served by the smallest
+    cached pixmap of that image that is at least as large.
+    """
+    def __init__(self, maxBytes=None, decoder=None, statCache=None, stats=None):
+        """
+        `maxBytes` -- the most bytes of decoded pixmaps to keep,
+            or None to size the cache based on available memory
+        `decoder` -- an ImageDecoder used to load pixmaps in the background,
+            the owner is responsible for passing decoded images to addImage
+        `statCache` -- a StatCache used to check whether uncached images exist,
+            cached pixmaps are returned without checking the filesystem
+        `stats` -- a CacheStats to count hits, misses and evictions in
+        """
+        self.stats = stats if stats is not None else CacheStats()
         self.clear()
+        self.maxBytes = maxBytes
+        self.decoder = decoder
+        self.statCache = statCache if statCache is not None else StatCache()
     
     def __getitem__(self, name):
-        return self._data[self.normKey(name)]
+        key = self._key(name)
+        # move to the most recently used end
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
     
     def __setitem__(self, name, value):
-        key = self.normKey(name)
-        if key not in self._list:
-            self._list.append(key)
+        key = self._key(name)
+        if key in self._data:
+            del self[key]
         self._data[key] = value
-        self.checkCount()
+        self._sizes[key] = self.pixmapBytes(value)
+        self._tiers.setdefault(key[0], set()).add(key[1])
+        self.bytes += self._sizes[key]
+        self.stats.recordBytes(self.bytes)
+        self.checkSize()
     
     def __delitem__(self, name):
-        key = self.normKey(name)
+        key = self._key(name)
         del self._data[key]
-        self._list.remove(key)
+        self._forget(key)
     
     @property
     def count(self):
-        return len(self._list)
-    
-    def checkCount(self):
-        """Check the current cache count and removed images if necessary"""
-        while self.count > max(0, self.maxCount):
+        return len(self._data)
+    
+    def getMaxBytes(self):
+        return self._maxBytes
+    def setMaxBytes(self, value):
+        if value is None:
+            value = getAutoCacheBytes()
+            LOG.debug('Pixmap cache budget: {0:.0f} MB'.format(value / 1024.0 ** 2))
+        self._maxBytes = value
+        self.checkSize()
+    maxBytes = property(getMaxBytes, setMaxBytes)
+    
+    @staticmethod
+    def pixmapBytes(pixmap):
+        """ Return the decoded size of the given pixmap in bytes """
+        return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+    
+    def sizeOf(self, path):
+        """ Return the size in bytes of all cached pixmaps for the given path, or 0 """
+        norm = self.normKey(path)
+        return sum([self._sizes[(norm, t)] for t in self._tiers.get(norm, ())])
+    
+    def checkSize(self):
+        """
+        Remove the least recently used pixmaps until the cache is within
+        its budget. The most recent pixmap is always kept.
+        """
+        while self.bytes > max(0, self.maxBytes) and self.count > 1:
+            self.stats.count('evictions')
+            self.stats.count('evictedBytes', self._sizes[next(iter(self._data))])
             self.pop()
     
     def clear(self):
-        self._list = []
-        self._data = {}
+        self._data = collections.OrderedDict()
+        # decoded size of each pixmap
+        self._sizes = {}
+        # cached resolution tiers of each path
+        self._tiers = {}
+        # the path and tier last requested by each view, so stats count
+        # each image a view displays once, rather than every read
+        self._displayed = {}
+        self.bytes = 0
     
     def pop(self):
+        """ Remove the least recently used pixmap """
         if self.count > 0:
-            del self[self._list[0]]
+            key = self._data.popitem(last=False)[0]
+            self._forget(key)
     
     def items(self):
         return self._data.items()
@@ -85,48 +623,344 @@ class PixmapCache(object):
     def values(self):
         return self._data.values()
     
-    def has_key(self, key):
-        return self._data.has_key(self.normKey(key))
+    def has_key(self, key, tier=None):
+        """ Return whether the given image is cached at the given tier or larger """
+        return self._findKey(key, tier) is not None
+    
+    def evict(self, paths):
+        """ Remove the given paths from the cache at all tiers, if they are cached """
+        for p in paths:
+            norm = self.normKey(p)
+            for t in list(self._tiers.get(norm, ())):
+                del self[(norm, t)]
+    
+    def add(self, path, tier=None):
+        """ Load the given image into the cache, in the background if possible """
+        self.getPixmap(path, wait=False, tier=tier)
     
-    def add(self, path):
-        self.getPixmap(path)
+    def addImage(self, path, image, tier=None):
+        """ Add a decoded QImage to the cache. Must be called on the GUI thread """
+        pixmap = QPixmap.fromImage(image)
+        self[(path, tier)] = pixmap
+        return pixmap
     
-    def getPixmap(self, path):
+    def isPending(self, path, tier=None):
+        """ Return whether the given image is being decoded in the background """
+        return self.decoder is not None and self.decoder.isPending(path, tier)
+    
+    def prefetch(self, path, priority=0, tier=None):
+        """
+        Decode the given image in the background before it is needed.
+        Images that are already cached are marked as recently used instead.
+        """
+        if self.decoder is None or not isinstance(path, (str, unicode)):
+            return
+        if self.touch(path, tier):
+            self.stats.count('prefetchHits')
+        elif not self.decoder.isPending(path, tier) and self.statCache.isfile(path):
+            self.stats.count('prefetchMisses')
+            self.decoder.request(path, priority, prefetch=True, tier=tier)
+    
+    def touch(self, path, tier=None):
+        """
+        Mark the given image as recently used if it is cached at the
+        given tier or larger. Returns whether the image is cached.
+        """
+        key = self._findKey(path, tier)
+        if key is None:
+            return False
+        self[key]
+        return True
+    
+    def getPixmap(self, path, wait=True, tier=None, view=None):
+        """
+        Return the pixmap for the given path at the given resolution tier,
+        loading it if necessary. If wait is False and the cache has a decoder,
+        a pixmap that is not cached yet is decoded in the background, and the
+        largest smaller tier that is cached, or a null pixmap, is returned
+        for now.
+        
+        `view` -- an id of the view displaying the pixmap. Hits and misses
+            are only counted when the image or tier of the view changes
+        """
         if not isinstance(path, (str, unicode)):
             return QPixmap()
-        if os.path.isfile(path):
-            if self.has_key(path):
-                # pixmap already loaded
-                return self[path]
-            else:
+        count = True
+        if view is not None:
+            request = (self.normKey(path), tier)
+            count = self._displayed.get(view) != request
+            self._displayed[view] = request
+        key = self._findKey(path, tier)
+        if key is not None:
+            # pixmap already loaded
+            if count:
+                self.stats.count('hits')
+            return self[key]
+        if self.statCache.isfile(path):
+            if count:
+                self.stats.count('misses')
+            if wait or self.decoder is None:
                 # load the pixmap
-                pixmap = QPixmap(path)
-                self[path] = pixmap
-                return pixmap
+                proxyCache = self.decoder.proxyCache if self.decoder is not None else None
+                return self.addImage(path, decodeImage(path, tier, proxyCache, self.stats), tier)
+            else:
+                self.decoder.request(path, tier=tier)
+                # show a lower resolution until the requested one is ready
+                key = self._findKey(path, 0, largest=True)
+                if key is not None:
+                    if count:
+                        self.stats.count('lowerTierHits')
+                    return self[key]
         return QPixmap()
     
+    def peek(self, path, tier=None):
+        """
+        Return the key of the cached pixmap that getPixmap would return
+        for the given image, or None, and whether the image is being
+        decoded, without marking anything as used or counting stats
+        """
+        if not isinstance(path, (str, unicode)):
+            return None, False
+        key = self._findKey(path, tier)
+        if key is None:
+            key = self._findKey(path, 0, largest=True)
+        return key, self.isPending(path, tier)
+    
     def normKey(self, path):
         return os.path.normpath(path).lower()
     
-    def cache(self, paths, keepOld=False):
-        normpaths = [self.normKey(p) for p in paths]
+    def _key(self, name):
+        """ Return the cache key for a path, or a (path, tier) tuple """
+        if isinstance(name, tuple):
+            return (self.normKey(name[0]), name[1])
+        return (self.normKey(name), None)
+    
+    def _findKey(self, path, tier=None, largest=False):
+        """
+        Return the key of the smallest cached pixmap of the given path that
+        covers the given tier, or the largest one if largest is True
+        """
+        norm = self.normKey(path)
+        tiers = [t for t in self._tiers.get(norm, ()) if coversTier(t, tier)]
+        if not len(tiers):
+            return
+        # full resolution is the largest tier
+        tiers.sort(key=lambda t: float('inf') if t is None else t)
+        return (norm, tiers[-1] if largest else tiers[0])
+    
+    def _forget(self, key):
+        """ Remove the size and tier records of a removed pixmap """
+        self.bytes -= self._sizes.pop(key)
+        tiers = self._tiers[key[0]]
+        tiers.discard(key[1])
+        if not len(tiers):
+            del self._tiers[key[0]]
+    
+    def cache(self, paths, keepOld=False, tier=None):
+        normpaths = set([self.normKey(p) for p in paths])
         removed = 0
         # remove unneded paths
         for k in self.keys():
-            if k not in normpaths:
+            if k[0] not in normpaths:
                 del self[k]
                 removed += 1
         # cache the rest
         added = 0
         for p in paths:
-            if not self.has_key(p):
-                self.getPixmap(p)
+            if not self.has_key(p, tier):
+                self.getPixmap(p, tier=tier)
                 added += 1
         LOG.debug('Updated pixmap cache. {0} removed, {1} added'.format(removed, added))
 
 
+class ImageCacheJob(QObject):
+    """
+    Decodes a list of images into a PixmapCache in the background,
+    using the cache's ImageDecoder. Only a few images are queued at a
+    time, so the job can be cancelled quickly, and no more images are
+    queued once the cache budget is full, rather than evicting the
+    images that were cached first.
+    
+    The owner is responsible for passing decoded images to addImage.
+    """
+    # number of images processed, total number of images
+    progress = Signal(int, int)
+    done = Signal(object)
+    
+    def __init__(self, cache, paths, tier=None, parent=None):
+        super(ImageCacheJob, self).__init__(parent)
+        self.cache = cache
+        self.paths = paths
+        self.tier = tier
+        self.processed = 0
+        self.cached = 0
+        self.isFull = False
+        self.isDone = False
+        self._next = 0
+        # cache keys of the images being decoded for this job
+        self._pending = set()
+        self._decodedBytes = 0
+        self._decodedCount = 0
+    
+    def __repr__(self):
+        return '<ImageCacheJob {0}/{1}>'.format(self.processed, self.total)
+    
+    @property
+    def total(self):
+        return len(self.paths)
+    
+    @property
+    def window(self):
+        """ The most images to be decoding at once """
+        return max(self.cache.decoder.getWorkerCount(process=True), 1) * 2
+    
+    def start(self):
+        self._queue()
+        self._checkDone()
+    
+    def cancel(self):
+        """
+        Stop queuing images. Images that are already being decoded
+        are still delivered to the model, but not to this job.
+        """
+        if not self.isDone:
+            LOG.debug('Cancelled caching images, {0} of {1} processed'.format(self.processed, self.total))
+            self._finish()
+    
+    def addImage(self, path, tier, image, force=False):
+        """
+        Add a decoded image to the cache if it was requested by this job
+        and fits within the cache budget, or if force is True.
+        Returns whether the image belonged to this job.
+        """
+        key = (self.cache.normKey(path), tier)
+        if self.isDone or key not in self._pending:
+            return False
+        self._pending.remove(key)
+        self.processed += 1
+        size = PixmapCache.pixmapBytes(image)
+        self._decodedBytes += size
+        self._decodedCount += 1
+        if force or self.cache.bytes + size <= self.cache.maxBytes:
+            self.cache.addImage(path, image, tier)
+            self.cached += 1
+        else:
+            self.isFull = True
+        self._queue()
+        self._checkDone()
+        return True
+    
+    def _queue(self):
+        """ Request images until the window or the cache budget is full """
+        while not self.isFull and len(self._pending) < self.window and self._next < self.total:
+            path = self.paths[self._next]
+            if self.cache.has_key(path, self.tier):
+                self._next += 1
+                self.processed += 1
+                self.cached += 1
+                continue
+            if self._decodedCount > 0:
+                # leave room for the images being decoded
+                average = self._decodedBytes // self._decodedCount
+                if self.cache.bytes + average * (len(self._pending) + 1) > self.cache.maxBytes:
+                    self.isFull = True
+                    break
+            self._next += 1
+            if not self.cache.statCache.isfile(path):
+                self.processed += 1
+                continue
+            self._pending.add((self.cache.normKey(path), self.tier))
+            # below prefetches, which are needed sooner
+            self.cache.decoder.request(path, -1000 - self._next, tier=self.tier, process=True)
+        self.progress.emit(self.processed, self.total)
+    
+    def _checkDone(self):
+        if not len(self._pending) and (self.isFull or self._next >= self.total):
+            if self.isFull:
+                LOG.warning('Pixmap cache is full, cached {0} of {1} images'.format(self.cached, self.total))
+            else:
+                LOG.debug('Cached {0} images'.format(self.cached))
+            self._finish()
+    
+    def _finish(self):
+        self.isDone = True
+        # images were queued most urgent first, so mark them as used in reverse
+        # to keep the most urgent ones from being evicted first
+        for path in reversed(self.paths[:self._next]):
+            self.cache.touch(path, self.tier)
+        self.done.emit(self)
+
+
+class ImageDirLoader(QThread):
+    """
+    Scans a directory for valid images in a background thread.
+    Images are emitted in batches as they are found, along with
+    the loader itself so that stale batches can be ignored.
+    """
+    imagesFound = Signal(object, list)
+    done = Signal(object)
+    
+    def __init__(self, collection, dir_, parent=None):
+        super(ImageDirLoader, self).__init__(parent)
+        self.collection = collection
+        self.dir_ = dir_
+        self.count = 0
+        self._isCancelled = False
+    
+    @property
+    def isCancelled(self):
+        return self._isCancelled
+    
+    def cancel(self):
+        self._isCancelled = True
+    
+    def run(self):
+        try:
+            for batch in self.collection.iterDir(self.dir_):
+                if self._isCancelled:
+                    break
+                self.count += len(batch)
+                self.imagesFound.emit(self, batch)
+        except OSError as e:
+            LOG.warning('Could not load images from {0}: {1}'.format(self.dir_, e))
+        self.done.emit(self)
+
+
+class ImageDirScanner(QThread):
+    """
+    Lists directories and stats their images in a background thread,
+    so that rescanning watched directories doesn't stall playback.
+    Emits the scanner and a list of (directory, modification times)
+    tuples, see ImageCollection.statDir.
+    """
+    scanned = Signal(object, list)
+    
+    def __init__(self, collection, dirs, parent=None):
+        super(ImageDirScanner, self).__init__(parent)
+        self.collection = collection
+        self.dirs = list(dirs)
+    
+    def run(self):
+        results = []
+        for dir_ in self.dirs:
+            try:
+                mtimes = self.collection.statDir(dir_)
+            except OSError:
+                # treat a missing directory as empty
+                mtimes = {}
+            results.append((dir_, mtimes))
+        self.scanned.emit(self, results)
+
 
 class StoryTimeModel(QAbstractItemModel):
+    # emitted with the number of images found while loading a directory
+    imageLoadProgress = Signal(int)
+    imageLoadFinished = Signal()
+    # number of images processed, total number of images
+    imageCacheProgress = Signal(int, int)
+    # number of images cached, total number of images
+    imageCacheFinished = Signal(int, int)
+    
     def __init__(self, parent=None):
         super(StoryTimeModel, self).__init__(parent)
         
@@ -150,9 +984,60 @@ class StoryTimeModel(QAbstractItemModel):
         # currently loaded/active recording collection index
         self.recordingIndex = 0
         # current image collection
-        self.imageCollection = ImageCollection()
-        # the pixmap cache for efficiency
-        self.pixmapCache = PixmapCache()
+        # file stats shared by the image collection and caches
+        self.statCache = StatCache()
+        self.imageCollection = ImageCollection(statCache=self.statCache)
+        # the pixmap cache for efficiency, loading images in the background
+        self.proxyCache = proxies.ProxyCache(self.getProxyDir(), statCache=self.statCache)
+        # hits, misses and decode times of the pixmap cache
+        self.cacheStats = CacheStats()
+        self.imageDecoder = ImageDecoder(proxyCache=self.proxyCache, stats=self.cacheStats, parent=self)
+        self.imageDecoder.imageDecoded.connect(self.imageDecoded)
+        self.pixmapCache = PixmapCache(decoder=self.imageDecoder, statCache=self.statCache, stats=self.cacheStats)
+        # largest dimension of the view displaying each pixmap mapping
+        self.imageViewSizes = {}
+        # seconds of the recording to decode ahead during playback
+        self.prefetchSeconds = 2.0
+        # number of images to decode ahead when browsing or recording
+        self.prefetchCount = 8
+        # the time or image index that the last prefetch started from
+        self._prefetchStart = None
+        # the direction images were last browsed in, 1 or -1
+        self._seekDirection = 1
+        # background directory loader, if images are being loaded
+        self.imageLoader = None
+        # background image caching job, if images are being cached
+        self.imageCacher = None
+        # whether to watch image directories for added, removed and changed images
+        self.watchImageDirs = False
+        self.imageDirWatcher = QFileSystemWatcher(self)
+        self.imageDirWatcher.directoryChanged.connect(self.imageDirChanged)
+        # directories waiting to be rescanned, gathered while changes come in
+        self._changedImageDirs = set()
+        # lists watched directories in the background
+        self.imageDirScanner = None
+        self.rescanTimer = QTimer(self)
+        self.rescanTimer.setSingleShot(True)
+        self.rescanTimer.setInterval(500)
+        self.rescanTimer.timeout.connect(self.rescanChangedImageDirs)
+        self.pollTimer = QTimer(self)
+        self.pollTimer.setInterval(POLL_INTERVAL)
+        self.pollTimer.timeout.connect(self.rescanImageDirs)
+        # mappings that may have changed since the last flush
+        self._dirtyMappings = set()
+        # the last values of each mapping that views were notified of
+        self._publishedValues = {}
+        # flushes changed mappings once control returns to the event loop
+        self.flushTimer = QTimer(self)
+        self.flushTimer.setSingleShot(True)
+        self.flushTimer.setInterval(0)
+        self.flushTimer.timeout.connect(self.flushChanges)
+        # whether new recordings use array-backed frame storage
+        self.compactRecordings = False
+        # crash recovery journal for the take being recorded
+        self.journal = None
+        # whether repeated images are merged into holds when a take is stopped
+        self.consolidateOnStop = False
         
         self.newRecording()
         LOG.debug('Model Initialized')
@@ -245,6 +1130,68 @@ class StoryTimeModel(QAbstractItemModel):
         path = os.path.join(self.getStoryTimePath(), filename)
         return path
     
+    def getProxyDir(self):
+        return os.path.join(self.getStoryTimePath(), 'proxies')
+    
+    def getJournalDir(self):
+        return os.path.join(self.getStoryTimePath(), 'journal')
+    
+    def getJournalPath(self, name):
+        filename = utils.normalizeFilename('{date}_{name}'.format(name=name, date=utils.timeString()))
+        return os.path.join(self.getJournalDir(), filename + journal.JOURNAL_EXT)
+    
+    def startJournal(self):
+        """ Start journaling the current recording while it is recorded """
+        self.journal = journal.RecordingJournal(self.getJournalPath(self.curRecording.name))
+        try:
+            if self._audioEnabled:
+                # record audio next to the journal so it survives a reboot
+                self.curAudioRecording.moveTempFile(self.getJournalDir())
+            self.journal.open(self.curRecording)
+        except (IOError, OSError) as e:
+            LOG.error('Unable to start recording journal: {0}'.format(e))
+            self.journal = None
+    
+    def stopJournal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        tempFile = self.curAudioRecording._tempFile
+        if tempFile is not None and os.path.dirname(tempFile) == self.getJournalDir():
+            # the audio is saved, so it no longer needs to survive a reboot
+            self.curAudioRecording.moveTempFile()
+    
+    def recoverRecordings(self):
+        """
+        Recover recordings from any journals left behind by takes that
+        were never stopped. Recovered recordings are saved and added to
+        the model. Returns the number of recordings recovered.
+        """
+        count = 0
+        for filename in journal.findJournals(self.getJournalDir()):
+            try:
+                if journal.isJournalLive(filename):
+                    LOG.debug('Skipping journal of a running Story Time: {0}'.format(filename))
+                    continue
+                recording, audioFile = journal.readJournal(filename, self.compactRecordings)
+            except (IOError, ValueError, KeyError) as e:
+                LOG.error('Unable to recover recording from journal {0}: {1}'.format(filename, e))
+                continue
+            if len(recording) == 0 and audioFile is None:
+                journal.removeJournal(filename)
+                continue
+            if audioFile is not None:
+                recording.audio.load(audioFile)
+                recording.audio.save(self.getAudioPath(recording.name))
+            self.addRecording(recording)
+            self.saveRecording(self.getRecordingPath(recording.name))
+            journal.removeJournal(filename)
+            if audioFile is not None and os.path.dirname(audioFile) == self.getJournalDir():
+                os.remove(audioFile)
+            LOG.info('Recovered recording from journal: {0}'.format(filename))
+            count += 1
+        return count
+    
     def moveAudioRecording(self, src, dst, recording):
         if os.path.isfile(src):
             os.remove(src)
@@ -301,7 +1248,7 @@ class StoryTimeModel(QAbstractItemModel):
         self.mappingChanged(Mappings.timeDisplay)
     
     def newRecording(self):
-        new = RecordingCollection()
+        new = RecordingCollection(frames=FrameRecording(compact=self.compactRecordings))
         new.name = self.getNewRecordingName()
         new.audio.inputDeviceIndex = self.audioInputDeviceIndex
         new.audio.outputDeviceIndex = self.audioOutputDeviceIndex
@@ -315,6 +1262,82 @@ class StoryTimeModel(QAbstractItemModel):
         # TODO: make sure we always have atleast one recording
         pass
     
+    @contextlib.contextmanager
+    def editRecording(self, index=None):
+        """
+        Edit a frame recording as a single batch. Yields the FrameRecording,
+        and updates the current image and emits one change notification
+        for all image and recording data once the edits are complete.
+        
+            with model.editRecording() as frames:
+                frames.splice(10, 20)
+                frames.retime([6] * 12, 10)
+        """
+        if index is None:
+            index = self.recordingIndex
+        frames = self.recordings[index].frames
+        with frames.batch():
+            yield frames
+        self.recordingEdited(index)
+    
+    def consolidateRecording(self, index=None):
+        """
+        Merge repeated images in the given recording into single holds.
+        Returns a mapping of old frame indices to new ones.
+        """
+        with self.editRecording(index) as frames:
+            mapping = frames.consolidate()
+        return mapping
+    
+    def setRecordingFps(self, fps, index=None):
+        """
+        Convert the given recording to a new frame rate, keeping its
+        cut points at the same times as closely as possible.
+        """
+        if index is None:
+            index = self.recordingIndex
+        frames = self.recordings[index].frames
+        if self.isRecording or fps == frames.fps:
+            return
+        if fps not in self._fpsOptions:
+            self.customFps = fps
+        oldFps = frames.fps
+        with self.editRecording(index) as frames:
+            frames.retimeToFps(fps)
+        if index == self.recordingIndex:
+            self.curTime = self.curTime * fps // oldFps
+            self.timeDataChanged()
+    
+    def recordingEdited(self, index):
+        """ Update the current image and views after the given recording was edited """
+        if index != self.recordingIndex:
+            return
+        if not self.isRecording:
+            frame = self.curFrameRecording.getFrame(self.curTime)
+            if frame is not None:
+                self.imageCollection.seekToImage(frame.image)
+        self.mappingsChanged(IMAGE_MAPPINGS + RECORDING_MAPPINGS)
+    
+    @property
+    def canUndo(self):
+        history = self.curFrameRecording.history
+        return not self.isRecording and history is not None and history.canUndo
+    
+    @property
+    def canRedo(self):
+        history = self.curFrameRecording.history
+        return not self.isRecording and history is not None and history.canRedo
+    
+    def undo(self):
+        """ Undo the last edit to the current recording """
+        if self.canUndo and self.curFrameRecording.undo():
+            self.recordingEdited(self.recordingIndex)
+    
+    def redo(self):
+        """ Redo the last undone edit to the current recording """
+        if self.canRedo and self.curFrameRecording.redo():
+            self.recordingEdited(self.recordingIndex)
+    
     def recordCurrentFrame(self):
         self.recordFrame(self.curImageIndex)
     
@@ -322,22 +1345,16 @@ class StoryTimeModel(QAbstractItemModel):
         """ Record the image at the given index for the current time """
         if index < 0 or index > len(self.images):
             return
-        recordingIndex = self.curFrameRecording.getIndex(self.curTime)
-        if recordingIndex is None:
-            # the first frame
-            recordingIndex = 0
-        else:
-            # insert after current frame
-            recordingIndex += 1
-        # get out time of the previous frame
-        outTime = self.curFrameRecording.outTime(recordingIndex - 1)
         image = self.images[index]
-        duration = self.curTime - outTime
-        if duration == 0:
-            LOG.warning('skipping frame recording, duration is 0: {0}. outTime {1} curTime {2}'.format(image, outTime, self.curTime))
+        recordingIndex = self.curFrameRecording.recordImage(image, self.curTime)
+        if recordingIndex is None:
+            LOG.warning('skipping frame recording, duration is 0: {0}. curTime {1}'.format(image, self.curTime))
             return
-        LOG.debug('index: {3}, {1:>4} - {2:<4}: {0}'.format(os.path.basename(image), outTime, outTime + duration, recordingIndex))
-        self.curFrameRecording.insert(recordingIndex, image, duration)
+        inTime = self.curFrameRecording.inTime(recordingIndex)
+        outTime = self.curFrameRecording.outTime(recordingIndex)
+        LOG.debug('index: {3}, {1:>4} - {2:<4}: {0}'.format(os.path.basename(image), inTime, outTime, recordingIndex))
+        if self.journal is not None:
+            self.journal.write(recordingIndex, image, outTime - inTime)
     
     
     # image collection methods
@@ -356,14 +1373,18 @@ class StoryTimeModel(QAbstractItemModel):
         xmls = [p for p in paths if os.path.splitext(p)[-1] in ['.xml']]
         images = [p for p in paths if p not in xmls]
         # handle images first
+        if len(images) > 0:
+            self.cancelImageLoad()
         if len(images) == 1:
             image = images[0]
             if os.path.isdir(image):
-                self.imageCollection.loadDir(image)
+                self.loadDir(image)
             else:
-                self.imageCollection.loadDir(os.path.dirname(image))
+                self.loadDir(os.path.dirname(image))
         elif len(images) > 1:
-            self.imageCollection.images = sorted(images)
+            self.imageCollection.images = images
+            self.imageCollection.sort()
+            self.updateImageDirWatch()
         # update the recording's name, if applicable
         self.updateRecordingName()
         # emit signals
@@ -386,14 +1407,88 @@ class StoryTimeModel(QAbstractItemModel):
             self.mappingChanged(Mappings.recordingName)
     
     def cacheAllImages(self):
-        # cache the images
+        """
+        Cache all images in the background, starting from the current
+        image and working outward. Cancels caching if already in progress.
+        """
+        if self.isCachingImages:
+            self.cancelImageCache()
+            return
         LOG.debug('Caching images...')
-        self.pixmapCache.cache(self.images)
+        self.imageCacher = ImageCacheJob(self.pixmapCache, self.getImagesAroundSeek(), self.getImageTier(Mappings.curImage), self)
+        self.imageCacher.progress.connect(self.imageCacheProgress)
+        self.imageCacher.done.connect(self.imageCacherDone)
+        self.imageCacher.start()
+    
+    @property
+    def isCachingImages(self):
+        return self.imageCacher is not None
+    
+    def cancelImageCache(self):
+        if self.imageCacher is not None:
+            self.imageCacher.cancel()
+    
+    def imageCacherDone(self, job):
+        if job is not self.imageCacher:
+            return
+        self.imageCacher = None
+        self.imageCacheFinished.emit(job.cached, job.total)
+    
+    def getImagesAroundSeek(self):
+        """ Return all images ordered by distance from the current image, alternating forward and back """
+        count = len(self.imageCollection)
+        seek = self.imageCollection.seek
+        images = []
+        for i in range(count):
+            # 0, 1, -1, 2, -2, ... in the current seek direction
+            offset = (i + 1) // 2 * (1 if i % 2 else -1) * self._seekDirection
+            images.append(self.imageCollection[(seek + offset) % count])
+        return images
     
     def clearCache(self):
         LOG.debug('Clearing cache {0}'.format(self.pixmapCache.count))
+        self.cancelImageCache()
         self.pixmapCache.clear()
     
+    def getCacheStats(self):
+        """
+        Return statistics about the pixmap cache as a dict, including
+        the counters and decode times of the cache's CacheStats
+        """
+        stats = self.cacheStats.toDict()
+        tiers = collections.defaultdict(int)
+        for norm, tier in self.pixmapCache.keys():
+            tiers[str(tier)] += 1
+        stats['resident'] = {
+            'bytes':self.pixmapCache.bytes,
+            'maxBytes':self.pixmapCache.maxBytes,
+            'count':self.pixmapCache.count,
+            'tiers':dict(tiers),
+        }
+        stats['pendingDecodes'] = len(self.imageDecoder._pending)
+        stats['proxyBytes'] = self.proxyCache.bytes
+        stats['prefetchSeconds'] = self.prefetchSeconds
+        stats['prefetchCount'] = self.prefetchCount
+        return stats
+    
+    def getCacheStatsDir(self):
+        return os.path.join(self.getStoryTimePath(), 'stats')
+    
+    def dumpCacheStats(self, filename=None):
+        """
+        Save the pixmap cache statistics to a json file, in the
+        stats directory by default. Returns the path of the file.
+        """
+        if filename is None:
+            dir_ = self.getCacheStatsDir()
+            if not os.path.isdir(dir_):
+                os.makedirs(dir_)
+            filename = os.path.join(dir_, 'cacheStats_{0}.json'.format(time.strftime('%Y%m%d_%H%M%S')))
+        with open(filename, 'wb') as fp:
+            json.dump(self.getCacheStats(), fp, indent=4)
+        LOG.info('Saved cache stats: {0}'.format(filename))
+        return filename
+    
     def toXml(self, platform=None, index=None):
         """
         Export the current recording collection to an editorial xml file.
@@ -405,8 +1500,8 @@ class StoryTimeModel(QAbstractItemModel):
         if index is None:
             index = self.recordingIndex
         recording = self.recordings[index]
-        frameImages = [f.image for f in recording.frames.frames]
-        frameDurations = [f.duration for f in recording.frames.frames]
+        frameImages = [f.image for f in recording.frames]
+        frameDurations = [f.duration for f in recording.frames]
         if platform is None:
             platform = sys.platform
         
@@ -435,7 +1530,7 @@ class StoryTimeModel(QAbstractItemModel):
             return
         with open(filename, 'rb') as fp:
             data = pickle.load(fp)
-        recording = RecordingCollection.fromString(data)
+        recording = RecordingCollection.fromString(data, self.compactRecordings)
         self.addRecording(recording)
         
         # attempt to load audio
@@ -444,9 +1539,16 @@ class StoryTimeModel(QAbstractItemModel):
             recording.audio.load(audioFile)
         
         LOG.info('Loaded recording: {0}'.format(filename))
-        # TODO: figure out a better way to encapsulate this functionality
-        allImages = sorted(list(set(self.images + recording.frames.images)))
-        self.images = allImages
+        # add the recorded images, keeping the directories being watched
+        images = [i for i in set(recording.frames.images) if i not in self.imageCollection]
+        if len(images):
+            image = self.imageCollection.current()
+            self.imageCollection.extend(images)
+            # natural sort, like images loaded from a directory
+            self.imageCollection.sort()
+            if image is not None:
+                self.imageCollection.seekToImage(image)
+        self.updateImageDirWatch()
     
     def saveRecording(self, filename=None, index=None):
         if index is None:
@@ -613,33 +1715,261 @@ class StoryTimeModel(QAbstractItemModel):
     
     @property
     def curImage(self):
-        return self.pixmapCache.getPixmap(self.curImagePath)
+        return self.getImagePixmap(Mappings.curImage)
     
     @property
     def prevImage(self):
-        return self.pixmapCache.getPixmap(self.imageCollection.prev(seek=False))
+        return self.getImagePixmap(Mappings.prevImage)
     
     @property
     def nextImage(self):
-        return self.pixmapCache.getPixmap(self.imageCollection.next(seek=False))
+        return self.getImagePixmap(Mappings.nextImage)
+    
+    def getUpcomingImages(self):
+        """
+        Return the images that are likely to be displayed next, in order.
+        During playback these are the images of the recording due in the
+        next prefetchSeconds, otherwise the next images in the direction
+        that the collection is being browsed.
+        """
+        if self.isPlaying:
+            end = self.curTime + int(self.prefetchSeconds * self.recordingFps)
+            return self.curFrameRecording.getImagesBetween(self.curTime, end)
+        count = len(self.imageCollection)
+        if count == 0:
+            return []
+        seek = self.imageCollection.seek
+        images = [self.imageCollection[(seek + self._seekDirection * i) % count] for i in range(min(self.prefetchCount, count))]
+        # keep the image behind the current one as well, for the previous image view
+        images.append(self.imageCollection[(seek - self._seekDirection) % count])
+        return images
+    
+    def prefetchImages(self):
+        """
+        Decode the upcoming images in the background, most urgent first.
+        Outstanding prefetches are cancelled when the playhead or image
+        seek jumps rather than advancing.
+        """
+        if self.isPlaying:
+            start = self.curTime
+            window = int(self.prefetchSeconds * self.recordingFps)
+            step = start - (self._prefetchStart or 0)
+        else:
+            start = self.imageCollection.seek
+            window = self.prefetchCount
+            step = (start - (self._prefetchStart or 0)) * self._seekDirection % max(len(self.imageCollection), 1)
+        if self._prefetchStart is not None and not 0 <= step <= window:
+            self.imageDecoder.cancelPrefetch()
+        self._prefetchStart = start
+        images = self.getUpcomingImages()
+        tier = self.getImageTier(Mappings.curImage)
+        # promote in reverse, so the most urgent images are the most recently used
+        for i in reversed(range(len(images))):
+            self.pixmapCache.prefetch(images[i], -1 - i, tier)
+    
+    def getImagePath(self, mapping):
+        """ Return the path of the image displayed by the given pixmap mapping """
+        if mapping == Mappings.curImage:
+            return self.imageCollection.current()
+        elif mapping == Mappings.prevImage:
+            return self.imageCollection.prev(seek=False)
+        elif mapping == Mappings.nextImage:
+            return self.imageCollection.next(seek=False)
+    
+    def getImagePixmap(self, mapping):
+        """ Return the pixmap for the given pixmap mapping, decoded at the size of its view """
+        return self.pixmapCache.getPixmap(self.getImagePath(mapping), wait=False, tier=self.getImageTier(mapping), view=mapping)
+    
+    def getImageTier(self, mapping):
+        """ Return the resolution tier needed by the view of the given pixmap mapping """
+        if mapping in self.imageViewSizes:
+            return getResolutionTier(self.imageViewSizes[mapping])
+    
+    def setImageViewSize(self, mapping, size):
+        """
+        Set the size in pixels of the view that displays the given pixmap
+        mapping, so that its images are decoded at a matching resolution
+        """
+        tier = self.getImageTier(mapping)
+        self.imageViewSizes[mapping] = size
+        if self.getImageTier(mapping) != tier:
+            self.mappingChanged(mapping)
+    
+    def isImagePending(self, mapping):
+        """ Return whether the image for the given pixmap mapping is still being decoded """
+        path = self.getImagePath(mapping)
+        return path is not None and self.pixmapCache.isPending(path, self.getImageTier(mapping))
+    
+    def imageDecoded(self, path, tier, image):
+        key = self.pixmapCache.normKey(path)
+        displayed = False
+        for m in PIXMAP_MAPPINGS:
+            p = self.getImagePath(m)
+            if p is not None and self.pixmapCache.normKey(p) == key:
+                displayed = True
+                break
+        if self.imageCacher is None or not self.imageCacher.addImage(path, tier, image, force=displayed):
+            self.pixmapCache.addImage(path, image, tier)
+        if displayed:
+            self.mappingsChanged(PIXMAP_MAPPINGS)
     
     def loadImageAtTime(self, time):
         frame = self.curFrameRecording.getFrame(time)
         if frame is not None:
             self.imageCollection.seekToImage(frame.image)
-            self.pixmapCache.add(self.nextImage)
+            self.prefetchImages()
             self.imageDataChanged()
             self.recordingDataChanged()
     
+    def loadDir(self, dir_, additive=False):
+        """
+        Load the images in the given directory in the background.
+        Images are added to the collection as they are found, and
+        the collection is sorted once the whole directory was scanned.
+        """
+        self.cancelImageLoad()
+        if not os.path.isdir(dir_):
+            LOG.warning('directory does not exist: {0}'.format(dir_))
+            return
+        if not additive:
+            self.imageCollection.clear()
+            self.imageDataChanged()
+        loader = ImageDirLoader(self.imageCollection, dir_, self)
+        loader.imagesFound.connect(self.imageLoaderImagesFound)
+        loader.done.connect(self.imageLoaderDone)
+        loader.finished.connect(loader.deleteLater)
+        self.imageLoader = loader
+        loader.start()
+        LOG.debug('Loading images from {0}'.format(dir_))
+    
+    @property
+    def isLoadingImages(self):
+        return self.imageLoader is not None
+    
+    def cancelImageLoad(self):
+        """ Stop loading images, keeping any that were already loaded """
+        if self.imageLoader is None:
+            return
+        self.imageLoader.cancel()
+        self.imageLoader = None
+        self.imageLoadFinished.emit()
+    
+    def imageLoaderImagesFound(self, loader, images):
+        if loader is not self.imageLoader:
+            return
+        # images of a recording opened during the load may already be listed
+        images = [i for i in images if i not in self.imageCollection]
+        self.imageCollection.extend(images)
+        self.imageLoadProgress.emit(loader.count)
+        self.imageDataChanged()
+    
+    def imageLoaderDone(self, loader):
+        if loader is not self.imageLoader:
+            return
+        self.imageLoader = None
+        # sort, keeping the current image
+        image = self.imageCollection.current()
+        self.imageCollection.sort()
+        if image is not None:
+            self.imageCollection.seekToImage(image)
+        LOG.debug('Loaded {0} image(s) from {1}'.format(loader.count, loader.dir_))
+        self.imageCollection.addDir(loader.dir_)
+        self.updateImageDirWatch()
+        self.updateRecordingName()
+        self.imageDataChanged()
+        self.imageLoadFinished.emit()
+    
+    def setWatchImageDirs(self, value):
+        self.watchImageDirs = value
+        self.updateImageDirWatch()
+    
+    def updateImageDirWatch(self):
+        """ Watch the directories of the current image collection, if enabled """
+        dirs = self.imageCollection.dirs if self.watchImageDirs else []
+        watched = self.imageDirWatcher.directories()
+        if len(watched):
+            self.imageDirWatcher.removePaths(watched)
+        # the directories changed, so any scan in progress is out of date
+        self.imageDirScanner = None
+        if len(dirs):
+            self.imageDirWatcher.addPaths(dirs)
+            # record modification times to compare against
+            self.rescanImageDirs()
+        if len(dirs) and POLL_IMAGE_DIRS:
+            self.pollTimer.start()
+        else:
+            self.pollTimer.stop()
+    
+    def imageDirChanged(self, dir_):
+        # changes tend to come in bursts, so wait a moment before rescanning
+        self._changedImageDirs.add(dir_)
+        self.rescanTimer.start()
+    
+    def rescanChangedImageDirs(self):
+        dirs = list(self._changedImageDirs)
+        self._changedImageDirs.clear()
+        self.rescanImageDirs(dirs)
+    
+    def rescanImageDirs(self, dirs=None):
+        """
+        Apply any changes to the given image directories, or all directories
+        of the current image collection. The directories are scanned in the
+        background, and only the changes are applied once the scan is done.
+        Only the pixmaps of removed or modified images are removed from the cache.
+        """
+        if self.isLoadingImages or not self.watchImageDirs:
+            return
+        if dirs is None:
+            dirs = self.imageCollection.dirs
+        if not len(dirs):
+            return
+        if self.imageDirScanner is not None:
+            # rescan once the current scan is done
+            self._changedImageDirs.update(dirs)
+            return
+        scanner = ImageDirScanner(self.imageCollection, dirs, self)
+        scanner.scanned.connect(self.imageDirsScanned)
+        scanner.finished.connect(scanner.deleteLater)
+        self.imageDirScanner = scanner
+        scanner.start()
+    
+    def imageDirsScanned(self, scanner, results):
+        if scanner is not self.imageDirScanner:
+            return
+        self.imageDirScanner = None
+        if self._changedImageDirs:
+            self.rescanTimer.start()
+        if self.isLoadingImages:
+            return
+        changed = False
+        for dir_, mtimes in results:
+            if os.path.normpath(dir_) not in self.imageCollection.dirs:
+                continue
+            added, removed, touched = self.imageCollection.rescanDir(dir_, mtimes)
+            self.pixmapCache.evict(removed + touched)
+            if len(added) or len(removed) or len(touched):
+                LOG.debug('Rescanned {0}: {1} added, {2} removed, {3} modified'.format(dir_, len(added), len(removed), len(touched)))
+                changed = True
+        if changed:
+            self.imageDataChanged()
+    
     def loadImage(self, index):
+        count = len(self.imageCollection)
+        if count > 1:
+            # shortest step between the indices, since seeking wraps around
+            step = (index - self.imageCollection.seek) % count
+            self._seekDirection = 1 if step <= count // 2 else -1
         self.imageCollection.seek = index
         # update cache
-        self.pixmapCache.add(self.nextImage)
+        self.prefetchImages()
         self.imageDataChanged()
         self.recordingDataChanged()
     
     def clearImages(self):
+        self.cancelImageLoad()
+        self.cancelImageCache()
         self.images = []
+        self.updateImageDirWatch()
         self.pixmapCache.clear()
         self.imageDataChanged()
     
@@ -676,6 +2006,9 @@ class StoryTimeModel(QAbstractItemModel):
             # loose equality
             if str(getattr(self, Mappings.names[m])) == str(value):
                 return False
+        # the view now shows the submitted value, so the model's
+        # value is published again only if it ends up different
+        self._publishedValues[m] = value
         
         if m not in [Mappings.curTime]:
             LOG.debug('{0:>25} = {1!r} -> {2!r}'.format(Mappings.names[index.column()], getattr(self, Mappings.names[m]), value))
@@ -711,15 +2044,23 @@ class StoryTimeModel(QAbstractItemModel):
             if not self.isRecording:
                 # recording has just stopped. record the last frame
                 self.recordCurrentFrame()
+                if self.consolidateOnStop:
+                    self.curFrameRecording.consolidate()
+                # the take is a single undo step
+                self.curFrameRecording.endBatch()
                 if self._audioEnabled:
                     # TODO: save the recording and audio (xml, wav) to getStoryTimePath
                     self.curAudioRecording.stop()
                     self.curAudioRecording.save(self.getAudioPath(self.curRecording.name))
                 self.saveRecording(self.getRecordingPath(self.curRecording.name))
+                # the take is saved, the journal is no longer needed
+                self.stopJournal()
             else:
                 if len(self.curFrameRecording) != 0:
                     # start a new recording cause this ones already been used
                     self.newRecording()
+                self.curFrameRecording.beginBatch()
+                self.startJournal()
                 if self._audioEnabled:
                     self.curAudioRecording.record()
             self.recordingDataChanged()
@@ -727,6 +2068,10 @@ class StoryTimeModel(QAbstractItemModel):
         
         elif m == Mappings.isPlaying:
             self.isPlaying = value
+            # prefetching switches between the timeline and the image collection
+            self.imageDecoder.cancelPrefetch()
+            self._prefetchStart = None
+            self.prefetchImages()
             if self.isPlaying:
                 if self._audioEnabled and self.curAudioRecording.hasRecording:
                     self.curAudioRecording.stop()
@@ -752,28 +2097,61 @@ class StoryTimeModel(QAbstractItemModel):
         return False
     
     def mappingChanged(self, mapping):
-        self.dataChanged.emit(self.mappingIndex(mapping), self.mappingIndex(mapping))
+        self.mappingsChanged((mapping,))
+    
+    def mappingsChanged(self, mappings):
+        """
+        Mark the given mappings as possibly changed. Views are notified
+        once control returns to the event loop, and only of the mappings
+        whose values actually changed, see flushChanges.
+        """
+        self._dirtyMappings.update(mappings)
+        if not self.flushTimer.isActive():
+            self.flushTimer.start()
+    
+    def flushChanges(self):
+        """
+        Compare the dirty mappings to the values that views were last
+        notified of, and emit dataChanged for each contiguous run of
+        mappings that changed.
+        """
+        self.flushTimer.stop()
+        dirty = sorted(self._dirtyMappings)
+        self._dirtyMappings.clear()
+        changed = []
+        for m in dirty:
+            value = self.getPublishedValue(m)
+            if m not in self._publishedValues or self._publishedValues[m] != value:
+                self._publishedValues[m] = value
+                changed.append(m)
+        start = 0
+        for i in range(1, len(changed) + 1):
+            if i == len(changed) or changed[i] != changed[i - 1] + 1:
+                self.dataChanged.emit(self.mappingIndex(changed[start]), self.mappingIndex(changed[i - 1]))
+                start = i
+    
+    def getPublishedValue(self, mapping):
+        """
+        Return a value of the given mapping that can be compared to tell
+        if it changed. Pixmaps are compared by the image, tier and cached
+        pixmap they would show, so only the view's own read of a changed
+        pixmap touches the cache and requests decodes.
+        """
+        if mapping in PIXMAP_MAPPINGS:
+            path = self.getImagePath(mapping)
+            tier = self.getImageTier(mapping)
+            key, pending = self.pixmapCache.peek(path, tier)
+            return ('pixmap', path, tier, key, pending)
+        return getattr(self, Mappings.names[mapping], None)
     
     def imageDataChanged(self):
-        self.mappingChanged(Mappings.imageCount)
-        self.mappingChanged(Mappings.curImageIndex)
-        self.mappingChanged(Mappings.curImageIndexLabel)
-        self.mappingChanged(Mappings.curImagePath)
-        self.mappingChanged(Mappings.curImage)
-        self.mappingChanged(Mappings.prevImage)
-        self.mappingChanged(Mappings.nextImage)
+        self.mappingsChanged(IMAGE_MAPPINGS)
     
     def recordingDataChanged(self):
-        self.mappingChanged(Mappings.recordingIndex)
-        self.mappingChanged(Mappings.recordingName)
-        self.mappingChanged(Mappings.recordingFps)
-        self.mappingChanged(Mappings.recordingDuration)
-        self.mappingChanged(Mappings.recordingDurationDisplay)
-        self.mappingChanged(Mappings.recordingImageCount)
+        self.mappingsChanged(RECORDING_MAPPINGS)
     
     def timeDataChanged(self):
-        self.mappingChanged(Mappings.curTime)
-        self.mappingChanged(Mappings.timeDisplay)
+        self.mappingsChanged(TIME_MAPPINGS)
     
     def index(self, row=0, column=0, parent=None):
         return self.createIndex(row, column)
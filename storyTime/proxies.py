@@ -0,0 +1,197 @@
+"""
+proxies.py
+
+Copyright (c) 2012 Moonbot Studios. All rights reserved.
+
+Provides a persistent cache of downscaled proxy images on local disk,
+so that boards don't need to be decoded from their full resolution
+source files every time they are loaded.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+LOG = logging.getLogger('storyTime.proxies')
+
+PROXY_EXT = '.proxy'
+# default size limit of the proxy cache on disk
+DEFAULT_PROXY_BYTES = 2 * 1024 ** 3
+# share of the size limit to trim down to, so a trim isn't needed on every write
+TRIM_FRACTION = 0.9
+
+
+class ProxyCache(object):
+    """
+    A cache of downscaled copies of source images, stored on disk.
+
+    Proxies are keyed by the source path, its size and modification time,
+    and the resolution tier, so editing a source image makes its old
+    proxies unreachable. Proxies are written to a temporary file and
+    renamed into place, so several threads or Story Time instances can
+    write to the same cache safely and a partial proxy is never read.
+
+    Reading a proxy updates its modification time. When the cache grows
+    beyond maxBytes, the least recently used proxies are removed.
+    """
+    def __init__(self, dir_, maxBytes=DEFAULT_PROXY_BYTES, quality=90, statCache=None):
+        self.dir_ = dir_
+        self.maxBytes = maxBytes
+        self.quality = quality
+        # optional StatCache for the source images
+        self.statCache = statCache
+        # guards the byte count, so writers never wait on a trim
+        self._lock = threading.Lock()
+        # held while walking the cache to trim or clear it
+        self._trimLock = threading.Lock()
+        # approximate size of all proxies, measured on the first trim
+        self.bytes = None
+
+    def __repr__(self):
+        return '<ProxyCache {0!r}>'.format(self.dir_)
+
+    def getProxyPath(self, path, tier):
+        """
+        Return the path of the proxy for the given source image and tier.
+        Returns None if the source image does not exist
+        """
+        if self.statCache is not None:
+            st = self.statCache.stat(path)
+        else:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+        if st is None:
+            return
+        key = u'{0}|{1}|{2}|{3}'.format(os.path.normpath(path), st.st_size, st.st_mtime, tier)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.dir_, digest[:2], digest + PROXY_EXT)
+
+    def get(self, path, tier):
+        """ Return the path of an existing proxy for the given image and tier, or None """
+        proxy = self.getProxyPath(path, tier)
+        if proxy is None:
+            return
+        try:
+            # mark as recently used
+            os.utime(proxy, None)
+        except OSError:
+            return
+        return proxy
+
+    def put(self, path, tier, image):
+        """
+        Save a scaled QImage as the proxy for the given image and tier.
+        Returns the path of the proxy, or None if it could not be saved.
+        Images smaller than the tier were not scaled, and are not saved,
+        since their proxy would only duplicate the source.
+        """
+        if image.isNull() or max(image.width(), image.height()) < tier:
+            return
+        proxy = self.getProxyPath(path, tier)
+        if proxy is None:
+            return
+        dir_ = os.path.dirname(proxy)
+        try:
+            if not os.path.isdir(dir_):
+                os.makedirs(dir_)
+        except OSError:
+            # another writer may have just created it
+            if not os.path.isdir(dir_):
+                return
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=dir_)
+        os.close(fd)
+        # jpeg decodes fastest, but only png keeps transparency
+        fmt = 'PNG' if image.hasAlphaChannel() else 'JPG'
+        if not image.save(tmp, fmt, self.quality):
+            LOG.warning('Could not save proxy for {0}'.format(path))
+            self._remove(tmp)
+            return
+        size = os.path.getsize(tmp)
+        try:
+            os.rename(tmp, proxy)
+        except OSError:
+            # windows won't replace an existing file. the other writer's proxy is just as good
+            self._remove(tmp)
+            return proxy
+        self.added(size)
+        return proxy
+
+    def added(self, size):
+        """
+        Record that a proxy of the given size was written to the cache,
+        trimming the cache in the background if it has grown beyond its
+        size limit. Only updates the byte count on the calling thread.
+        """
+        with self._lock:
+            if self.bytes is not None:
+                self.bytes += size
+            needsTrim = self.bytes is None or self.bytes > self.maxBytes
+        if needsTrim:
+            self.trimInBackground()
+
+    def trimInBackground(self):
+        """ Trim the cache on a new thread, unless it is already being trimmed """
+        if self._trimLock.locked():
+            return
+        thread = threading.Thread(target=self.trim, name='ProxyCache.trim')
+        thread.daemon = True
+        thread.start()
+
+    def trim(self):
+        """ Remove the least recently used proxies until the cache is within its size limit """
+        if not self._trimLock.acquire(False):
+            # already trimming on another thread
+            return
+        try:
+            proxies = []
+            total = 0
+            for root, dirs, files in os.walk(self.dir_):
+                for f in files:
+                    p = os.path.join(root, f)
+                    try:
+                        st = os.stat(p)
+                    except OSError:
+                        continue
+                    if not f.endswith(PROXY_EXT):
+                        # leftover temp file from a writer that was interrupted
+                        if f.endswith('.tmp') and st.st_mtime < time.time() - 3600:
+                            self._remove(p)
+                        continue
+                    proxies.append((st.st_mtime, st.st_size, p))
+                    total += st.st_size
+            if total > self.maxBytes:
+                proxies.sort()
+                target = self.maxBytes * TRIM_FRACTION
+                removed = 0
+                for mtime, size, p in proxies:
+                    if total <= target:
+                        break
+                    if self._remove(p):
+                        total -= size
+                        removed += 1
+                LOG.debug('Trimmed {0} proxies from {1}'.format(removed, self.dir_))
+            with self._lock:
+                self.bytes = total
+        finally:
+            self._trimLock.release()
+
+    def clear(self):
+        """ Remove all proxies """
+        with self._trimLock:
+            for root, dirs, files in os.walk(self.dir_):
+                for f in files:
+                    self._remove(os.path.join(root, f))
+            with self._lock:
+                self.bytes = 0
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
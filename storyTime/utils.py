@@ -3,6 +3,7 @@ from PySide.QtCore import *
 from PySide.QtGui import *
 from PySide.QtUiTools import QUiLoader
 from datetime import datetime
+import errno
 import logging
 import math
 import os
@@ -205,4 +206,83 @@ def getOS():
     elif (sys.platform.lower() == "darwin"):
         return "mac"
     else:
-        return "linux"
\ No newline at end of file
+        return "linux"
+
+def isProcessRunning(pid):
+    '''
+    Return whether a process with the given id is running on this machine
+    '''
+    if getOS() == 'windows':
+        import ctypes
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        STILL_ACTIVE = 259
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return False
+        code = ctypes.c_ulong()
+        running = kernel32.GetExitCodeProcess(handle, ctypes.byref(code)) and code.value == STILL_ACTIVE
+        kernel32.CloseHandle(handle)
+        return bool(running)
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # the process exists, but belongs to another user
+        return e.errno == errno.EPERM
+    return True
+
+def getMemInfo(name, path='/proc/meminfo'):
+    '''
+    Return the value of the given field of /proc/meminfo in bytes,
+    or None if it is not available, eg. on kernels older than 3.14
+    '''
+    try:
+        with open(path) as fp:
+            for line in fp:
+                key, _, value = line.partition(':')
+                if key == name:
+                    # values are in kB
+                    return int(value.split()[0]) * 1024
+    except (IOError, ValueError, IndexError):
+        pass
+    return None
+
+def getAvailableMemory():
+    '''
+    Get the available physical memory of the system in bytes.
+    Returns None if it cannot be determined
+    '''
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    if getOS() == 'windows':
+        import ctypes
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [
+                ('dwLength', ctypes.c_ulong),
+                ('dwMemoryLoad', ctypes.c_ulong),
+                ('ullTotalPhys', ctypes.c_ulonglong),
+                ('ullAvailPhys', ctypes.c_ulonglong),
+                ('ullTotalPageFile', ctypes.c_ulonglong),
+                ('ullAvailPageFile', ctypes.c_ulonglong),
+                ('ullTotalVirtual', ctypes.c_ulonglong),
+                ('ullAvailVirtual', ctypes.c_ulonglong),
+                ('ullAvailExtendedVirtual', ctypes.c_ulonglong),
+            ]
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+        return None
+    if getOS() == 'linux':
+        available = getMemInfo('MemAvailable')
+        if available is not None:
+            return available
+    try:
+        # free memory only, which leaves out reclaimable page cache
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        # not available on mac
+        return None
@@ -0,0 +1,156 @@
+"""
+workers.py
+
+Copyright (c) 2012 Moonbot Studios. All rights reserved.
+
+Functions that decode images in worker processes. Decoded pixels are
+written to a file in shared memory (or the temp directory) so that the
+GUI process can map them as a QImage without copying.
+
+This module must not import Qt, so that worker processes stay light.
+"""
+
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+LOG = logging.getLogger('storyTime.workers')
+
+# file extension of decoded pixel buffers
+BUFFER_EXT = '.raw'
+
+
+def isAvailable():
+    """ Return whether images can be decoded in worker processes """
+    return Image is not None
+
+
+def getBufferDir():
+    """
+    Return a new directory for decoded pixel buffers, in shared
+    memory when the system has it, so buffers never touch the disk
+    """
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    return tempfile.mkdtemp(prefix='storyTime_decode_', dir=base)
+
+
+def createPool(processes=None):
+    """ Return a new process pool for decoding images, with one process per core by default """
+    return multiprocessing.Pool(processes)
+
+
+def decodeToBuffer(path, tier, bufferDir, proxy=None, quality=90):
+    """
+    Decode an image so that it fits within the given resolution tier
+    and write its pixels to a new file in bufferDir.
+
+    If a proxy path is given, the proxy is decoded instead if it exists,
+    and otherwise it is saved from the image if it had to be scaled.
+
+    Returns a dict with the buffer path, width, height, bytesPerLine,
+    whether the pixels have alpha, the size of any proxy that was saved,
+    and how long decoding took, or a dict with an error message.
+    Never raises, since a process pool would drop the result of a
+    failed job.
+    """
+    try:
+        return _decodeToBuffer(path, tier, bufferDir, proxy, quality)
+    except Exception as e:
+        return {'error':'{0}: {1}'.format(type(e).__name__, e)}
+
+
+def _decodeToBuffer(path, tier, bufferDir, proxy, quality):
+    proxyBytes = 0
+    image = None
+    start = time.time()
+    if proxy is not None and os.path.isfile(proxy):
+        try:
+            image = Image.open(proxy)
+            image.load()
+            # mark as recently used
+            os.utime(proxy, None)
+        except (IOError, OSError):
+            image = None
+    fromProxy = image is not None
+    scaled = False
+    if image is None:
+        image = Image.open(path)
+        scaled = tier is not None and max(image.size) > tier
+        if scaled:
+            # let jpeg decode at a reduced size, then scale the rest of the way
+            image.draft(image.mode, (tier, tier))
+            image.thumbnail((tier, tier), Image.ANTIALIAS)
+        else:
+            image.load()
+    decodeTime = time.time() - start
+    if scaled and proxy is not None:
+        proxyBytes = _saveProxy(image, proxy, quality)
+    hasAlpha = image.mode in ('RGBA', 'LA', 'P') and (image.mode != 'P' or 'transparency' in image.info)
+    if hasAlpha:
+        image = image.convert('RGBA')
+        # the byte order of QImage.Format_ARGB32 on little endian machines
+        data = _toBytes(image, 'BGRA')
+        bytesPerLine = image.size[0] * 4
+    else:
+        image = image.convert('RGB')
+        data = _toBytes(image, 'RGB')
+        bytesPerLine = image.size[0] * 3
+    fd, buf = tempfile.mkstemp(suffix=BUFFER_EXT, dir=bufferDir)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    return {
+        'buffer':buf,
+        'width':image.size[0],
+        'height':image.size[1],
+        'bytesPerLine':bytesPerLine,
+        'hasAlpha':hasAlpha,
+        'proxyBytes':proxyBytes,
+        'decodeTime':decodeTime,
+        'fromProxy':fromProxy,
+    }
+
+
+def _toBytes(image, rawmode):
+    if hasattr(image, 'tobytes'):
+        return image.tobytes('raw', rawmode)
+    # older versions of PIL
+    return image.tostring('raw', rawmode)
+
+
+def _saveProxy(image, proxy, quality):
+    """
+    Save a scaled image as a proxy, in the same formats as ProxyCache.put.
+    Returns the size of the proxy, or 0 if it could not be saved
+    """
+    dir_ = os.path.dirname(proxy)
+    try:
+        if not os.path.isdir(dir_):
+            os.makedirs(dir_)
+    except OSError:
+        if not os.path.isdir(dir_):
+            return 0
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=dir_)
+    os.close(fd)
+    try:
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image.save(tmp, 'PNG')
+        else:
+            image.convert('RGB').save(tmp, 'JPEG', quality=quality)
+        size = os.path.getsize(tmp)
+        os.rename(tmp, proxy)
+        return size
+    except (IOError, OSError):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return 0
@@ -0,0 +1,47 @@
+"""
+test_data.py
+
+Copyright (c) 2012 Moonbot Studios. All rights reserved.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'storyTime'))
+from data import FrameRecording, RecordingHistory
+
+
+class TestConsolidate(unittest.TestCase):
+    
+    def getConcatenated(self, compact):
+        a = FrameRecording(compact=compact)
+        for image, duration in [('x', 1), ('x', 2), ('x', 3)]:
+            a.append(image, duration)
+        b = FrameRecording(compact=compact)
+        b.append('y', 4)
+        # stored as segments shared with a and b
+        recording = a + b
+        recording.history = RecordingHistory()
+        return recording
+    
+    def checkConsolidateUndo(self, compact):
+        recording = self.getConcatenated(compact)
+        before = [(f.image, f.duration) for f in recording]
+        self.assertEqual(list(recording.consolidate()), [0, 0, 0, 1])
+        self.assertEqual([(f.image, f.duration) for f in recording], [('x', 6), ('y', 4)])
+        self.assertEqual(recording.getIndex(recording.start + 6), 1)
+        self.assertTrue(recording.undo())
+        self.assertEqual([(f.image, f.duration) for f in recording], before)
+        self.assertEqual(recording.duration, 10)
+        self.assertEqual(recording.getIndex(recording.start + 3), 2)
+    
+    def testConsolidateUndoList(self):
+        self.checkConsolidateUndo(False)
+    
+    def testConsolidateUndoCompact(self):
+        self.checkConsolidateUndo(True)
+
+
+if __name__ == '__main__':
+    unittest.main()